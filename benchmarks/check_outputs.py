@@ -0,0 +1,192 @@
+"""
+Regression checks of the LiDAR output. The vectorized payload encoding, the PcapWriter, the process pool and the udp
+replay have to produce exactly the bytes of the original implementation (payloads built byte by byte with
+dec_to_hexbyte, packets built with scapy and written with wrpcap, scans encoded one after another). The checks run
+on a synthetic dataset:
+
+    python -m benchmarks.check_outputs
+
+They are run by run_benchmarks as well, which fails if one of them does not pass.
+"""
+# Imports
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path:
+    sys.path.insert(0, repo_dir)
+
+from benchmarks import synthetic
+
+
+def reference_payload(ranges, intensities, angles, timestamp):
+    """
+    Payload of one packet as built by the original create_velodyne_payload.
+    """
+    from src import LiDAR as LI
+    payload = b''
+    for i in range(12):
+        payload += LI.flag
+        payload += LI.dec_to_hexbyte(angles[0, i], num_bytes=2)
+        for j in range(32):
+            payload += LI.dec_to_hexbyte(ranges[j, i], num_bytes=2)
+            payload += LI.dec_to_hexbyte(intensities[j, i])
+    payload += LI.dec_to_hexbyte(LI.convert_timestamp(timestamp[0]), num_bytes=4)
+    payload += LI.factory_byte
+    return payload
+
+
+def reference_payloads(filename):
+    from src import LiDAR as LI
+    ranges, intensities, angles, timestamps = LI.load_velodyne_raw(filename)
+    return [reference_payload(ranges[:, i * 12:i * 12 + 12], intensities[:, i * 12:i * 12 + 12],
+                              angles[:, i * 12:i * 12 + 12], timestamps[:, i]) for i in range(timestamps.shape[1])]
+
+
+def first_difference(expected, actual):
+    """
+    :return: Description of the first difference of two lists of bytes objects, None if they are equal
+    """
+    for i, (a, b) in enumerate(zip(expected, actual)):
+        if bytes(a) != bytes(b):
+            length = min(len(a), len(b))
+            offset = next((j for j in range(length) if a[j] != b[j]), length)
+            return "item {} differs at byte {}".format(i, offset)
+    if len(expected) != len(actual):
+        return "{} items expected, got {}".format(len(expected), len(actual))
+    return None
+
+
+def check_payloads(files, reference):
+    """
+    LiDAR.create_velodyne_payloads against the byte-wise encoding.
+    """
+    from src import LiDAR as LI
+    actual = []
+    for filename in files:
+        actual.extend(bytes(payload) for payload in LI.create_velodyne_payloads(*LI.load_velodyne_raw(filename)))
+    return first_difference(reference, actual)
+
+
+def check_pcap_writer(files, reference, workdir):
+    """
+    PcapWriter against scapy's wrpcap. The record timestamps differ (scapy uses the creation time of the packet
+    objects), so the global header and the frames are compared.
+    """
+    from scapy.utils import wrpcap
+    from src import LiDAR as LI
+    from src import PcapSegments as PS
+    from src.PcapWriter import PcapWriter
+
+    scapy_path = os.path.join(workdir, 'scapy.pcap')
+    writer_path = os.path.join(workdir, 'pcap_writer.pcap')
+    wrpcap(scapy_path, [LI.build_packet(payload) for payload in reference])
+    with PcapWriter(writer_path) as writer:
+        for payload in reference:
+            writer.write(payload)
+
+    with open(scapy_path, 'rb') as f_scapy, open(writer_path, 'rb') as f_writer:
+        if f_scapy.read(24) != f_writer.read(24):
+            return "global headers differ"
+    return first_difference([frame for _, frame in PS.read_records(scapy_path)],
+                            [frame for _, frame in PS.read_records(writer_path)])
+
+
+def check_pool(files, reference, workers=2):
+    """
+    LiDARPool.encode_scans with a process pool against the serial encoding.
+    """
+    from src import LiDARPool as LP
+    actual = []
+    for payloads, _ in LP.encode_scans(files, workers=workers):
+        actual.extend(bytes(payload) for payload in payloads)
+    return first_difference(reference, actual)
+
+
+def check_udp_replay(files, reference, timeout=0.5):
+    """
+    UdpReplayer against start_udp_receiver on the loopback interface. The data packets have to arrive unchanged on
+    2368 and every 15th packet has to be a position packet on 8308, as sent by main.
+    """
+    from src import LiDAR as LI
+    from src.UdpReplay import UdpReplayer, start_udp_receiver
+    position_payload = bytes(range(256)) * 2
+    received = {}
+
+    def receive(port):
+        received[port] = start_udp_receiver(port, timeout=timeout, address='127.0.0.1')
+
+    receivers = [threading.Thread(target=receive, args=(port,)) for port in (2368, 8308)]
+    for receiver in receivers:
+        receiver.start()
+    # The receivers have to be bound before the first packet is sent
+    time.sleep(0.1)
+
+    counter = 1
+    with UdpReplayer('127.0.0.1') as replayer:
+        for filename in files:
+            ranges, intensities, angles, timestamps = LI.load_velodyne_raw(filename)
+            for p, payload in enumerate(LI.create_velodyne_payloads(ranges, intensities, angles, timestamps)):
+                if counter % 15 == 0:
+                    replayer.send(position_payload, timestamps[0, p], port=8308)
+                replayer.send(payload, timestamps[0, p], port=2368)
+                counter += 1
+        stats = replayer.close()
+    for receiver in receivers:
+        receiver.join()
+
+    positions = len(reference) // 15
+    difference = first_difference(reference, received[2368])
+    if difference:
+        return "data packets: " + difference
+    if received[8308] != [position_payload] * positions:
+        return "{} position packets received, {} expected".format(len(received[8308]), positions)
+    if stats['packets'] != len(reference) + positions or not stats['duration_s'] > 0:
+        return "statistics of {} packets in {} s".format(stats['packets'], stats['duration_s'])
+    return None
+
+
+def run_checks(lidar_dir, workdir, max_scans=2):
+    """
+    Runs all checks on the first scans of a lidar directory.
+    :param lidar_dir: Directory of the raw Velodyne scans
+    :param workdir: Directory for the written pcaps
+    :param max_scans: Amount of scans checked, the byte-wise reference encoding is slow
+    :return: Dictionary of the checks with None if passed, otherwise the first difference
+    """
+    files = [os.path.join(lidar_dir, x) for x in sorted(os.listdir(lidar_dir)) if x.endswith('.png')][:max_scans]
+    reference = []
+    for filename in files:
+        reference.extend(reference_payloads(filename))
+    return {'payloads': check_payloads(files, reference),
+            'pcap_writer': check_pcap_writer(files, reference, workdir),
+            'pool': check_pool(files, reference),
+            'udp_replay': check_udp_replay(files, reference)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sensor Emulator Output Checks")
+    parser.add_argument('--scans', type=int, default=3, help='Amount of generated lidar scans.')
+    parser.add_argument('--packets', type=int, default=20, help='Amount of packets per lidar scan.')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='emulator_check_')
+    try:
+        lidar_dir = synthetic.generate_lidar_dataset(workdir, scans=args.scans, packets=args.packets)
+        results = run_checks(lidar_dir, workdir, args.scans)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name, difference in results.items():
+        print('{}: {}'.format(name, 'ok' if difference is None else 'FAILED, ' + difference))
+    if any(difference is not None for difference in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
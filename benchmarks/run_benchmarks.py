@@ -0,0 +1,356 @@
+"""
+Benchmarks of the LiDAR and camera stages of the emulator and of the end-to-end runs of main.py on synthetic data.
+
+Every stage runs in its own process, so its peak RSS can be measured. The results are written as json and can be
+compared against a saved baseline:
+
+    python -m benchmarks.run_benchmarks --output baseline.json
+    python -m benchmarks.run_benchmarks --output results.json --baseline baseline.json
+"""
+# Imports
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path:
+    sys.path.insert(0, repo_dir)
+
+from benchmarks import check_outputs, synthetic, upscale_server
+
+scales = {
+    'small': {'scans': 5, 'packets': 180, 'frames': 10, 'width': 640, 'height': 480},
+    'medium': {'scans': 50, 'packets': 180, 'frames': 50, 'width': 1280, 'height': 960},
+    'large': {'scans': 600, 'packets': 180, 'frames': 500, 'width': 1280, 'height': 960},
+}
+
+stage_names = ['load_velodyne_raw', 'create_velodyne_payload', 'create_velodyne_payloads', 'build_packet', 'wrpcap',
+               'pcap_writer', 'resize_image', 'rectify_images', 'resample_frames', 'main_lidar', 'main_camera']
+
+
+class SkipStage(Exception):
+    """
+    Raised by a stage whose requirements (e.g. the robotcar_dataset_sdk or ffmpeg) are not available.
+    """
+
+
+def lidar_dir(workdir):
+    return os.path.join(workdir, 'lidar', 'dataset', 'data', 'velodyne_left')
+
+
+def camera_dir(workdir):
+    return os.path.join(workdir, 'camera', 'dataset', 'data', 'stereo', 'centre')
+
+
+def scan_files(workdir):
+    directory = lidar_dir(workdir)
+    return [os.path.join(directory, x) for x in sorted(os.listdir(directory)) if x.endswith('.png')]
+
+
+def load_scans(workdir):
+    from src import LiDAR as LI
+    return [LI.load_velodyne_raw(filename) for filename in scan_files(workdir)]
+
+
+def data_payloads(workdir):
+    from src import LiDAR as LI
+    payloads = []
+    for ranges, intensities, angles, timestamps in load_scans(workdir):
+        payloads.extend(bytes(p) for p in LI.create_velodyne_payloads(ranges, intensities, angles, timestamps))
+    return payloads
+
+
+def copy_camera_dir(workdir):
+    """
+    Stages which change the images in place work on a copy of the camera directory.
+    """
+    target = os.path.join(workdir, 'camera_copy', 'centre') + '/'
+    shutil.rmtree(os.path.dirname(os.path.dirname(target)), ignore_errors=True)
+    shutil.copytree(camera_dir(workdir), target)
+    return target
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    function(*args)
+    return time.perf_counter() - start, time.process_time() - cpu_start
+
+
+def stage_load_velodyne_raw(workdir):
+    from src import LiDAR as LI
+    files = scan_files(workdir)
+    seconds, cpu = timed(lambda: [LI.load_velodyne_raw(f) for f in files])
+    return len(files), 'scans', seconds, cpu
+
+
+def stage_create_velodyne_payload(workdir):
+    from src import LiDAR as LI
+    scans = load_scans(workdir)
+
+    def run():
+        for ranges, intensities, angles, timestamps in scans:
+            for i in range(timestamps.shape[1]):
+                LI.create_velodyne_payload(ranges[:, i * 12:i * 12 + 12], intensities[:, i * 12:i * 12 + 12],
+                                           angles[:, i * 12:i * 12 + 12], timestamps[:, i])
+    seconds, cpu = timed(run)
+    return sum(s[3].shape[1] for s in scans), 'packets', seconds, cpu
+
+
+def stage_create_velodyne_payloads(workdir):
+    from src import LiDAR as LI
+    scans = load_scans(workdir)
+    seconds, cpu = timed(lambda: [LI.create_velodyne_payloads(*scan) for scan in scans])
+    return sum(s[3].shape[1] for s in scans), 'packets', seconds, cpu
+
+
+def stage_build_packet(workdir):
+    from src import LiDAR as LI
+    payloads = data_payloads(workdir)
+    seconds, cpu = timed(lambda: [LI.build_packet(p) for p in payloads])
+    return len(payloads), 'packets', seconds, cpu
+
+
+def stage_wrpcap(workdir):
+    from src import LiDAR as LI
+    from scapy.utils import wrpcap
+    packets = [LI.build_packet(p) for p in data_payloads(workdir)]
+    out_path = os.path.join(workdir, 'wrpcap.pcap')
+    seconds, cpu = timed(wrpcap, out_path, packets)
+    return len(packets), 'packets', seconds, cpu
+
+
+def stage_pcap_writer(workdir):
+    from src.PcapWriter import PcapWriter
+    payloads = data_payloads(workdir)
+
+    def run():
+        with PcapWriter(os.path.join(workdir, 'pcap_writer.pcap')) as writer:
+            for payload in payloads:
+                writer.write(payload)
+    seconds, cpu = timed(run)
+    return len(payloads), 'packets', seconds, cpu
+
+
+def stage_resize_image(workdir):
+    try:
+        from src import ImagePreprocessing as im
+    except ImportError as e:
+        raise SkipStage(str(e))
+    directory = copy_camera_dir(workdir)
+    seconds, cpu = timed(im.resize_image, directory, 0.5)
+    return len(os.listdir(directory)), 'frames', seconds, cpu
+
+
+def stage_rectify_images(workdir):
+    try:
+        from src import ImagePreprocessing as im
+    except ImportError as e:
+        raise SkipStage(str(e))
+    models_path = os.path.join(repo_dir, 'robotcar_dataset_sdk', 'models') + '/'
+    if not os.path.isdir(models_path):
+        raise SkipStage("Camera models not found in {}.".format(models_path))
+    directory = copy_camera_dir(workdir)
+    seconds, cpu = timed(im.rectify_images, directory, models_path)
+    return len(os.listdir(directory)), 'frames', seconds, cpu
+
+
+def stage_resample_frames(workdir):
+    from src import FrameTiming as FT
+    from src import VideoConverter as VC
+    directory = camera_dir(workdir) + '/'
+    image_list, timestamps = FT.frame_timestamps(os.listdir(directory))
+
+    frames = []
+
+    def run():
+        # The frames are decoded as for the video, the blended frames are only counted
+        frames.extend(1 for _ in FT.resample_frames(VC.read_frames(directory, image_list), timestamps, 25))
+    seconds, cpu = timed(run)
+    return len(frames), 'frames', seconds, cpu
+
+
+def run_main(workdir, *args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([repo_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.join(repo_dir, 'main.py')] + list(args), cwd=workdir, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise Exception("main.py {} failed: {}".format(' '.join(args), result.stderr.decode()[-500:]))
+    return seconds
+
+
+def require_main_imports():
+    """
+    main.py imports the camera modules for every sensor, so it can not run without the robotcar_dataset_sdk.
+    """
+    try:
+        from src import ImagePreprocessing
+    except ImportError as e:
+        raise SkipStage("main.py can not be imported: {}".format(e))
+
+
+def stage_main_lidar(workdir):
+    require_main_imports()
+    directory = os.path.join(workdir, 'lidar')
+    shutil.rmtree(os.path.join(directory, 'out'), ignore_errors=True)
+    seconds = run_main(directory, '--sensor', 'lidar')
+    # 14 data packets are followed by one position packet
+    packets = sum(s[3].shape[1] for s in load_scans(workdir))
+    return packets + packets // 15, 'packets', seconds, None
+
+
+def stage_main_camera(workdir):
+    require_main_imports()
+    if shutil.which('ffmpeg') is None:
+        raise SkipStage("ffmpeg not found.")
+    directory = os.path.join(workdir, 'camera')
+    shutil.rmtree(os.path.join(directory, 'out'), ignore_errors=True)
+    seconds = run_main(directory, '--sensor', 'camera')
+    return len(os.listdir(camera_dir(workdir))), 'frames', seconds, None
+
+
+def run_stage(name, workdir):
+    """
+    Runs one stage in the current process and prints its result as json.
+    """
+    try:
+        items, unit, seconds, cpu = globals()['stage_' + name](workdir)
+        # Peak RSS of this process or of main.py for the end-to-end stages (in kB on linux)
+        peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        result = {'status': 'ok', 'items': items, 'unit': unit, 'seconds': seconds, 'cpu_seconds': cpu,
+                  'throughput': items / seconds if seconds > 0 else None, 'peak_rss_kb': peak_rss_kb}
+    except SkipStage as e:
+        result = {'status': 'skipped', 'reason': str(e)}
+    print(json.dumps(result))
+
+
+def measure_stage(name, workdir):
+    """
+    Runs one stage in a separate process, so the peak RSS of the stage is not influenced by the other stages.
+    """
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.run_benchmarks', '--run-stage', name,
+                             '--workdir', workdir], cwd=repo_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return {'status': 'error', 'reason': result.stderr.decode(errors='replace')[-500:]}
+    return json.loads(result.stdout.decode().strip().splitlines()[-1])
+
+
+def generate_data(workdir, scale):
+    synthetic.generate_lidar_dataset(os.path.join(workdir, 'lidar', 'dataset', 'data'), scans=scale['scans'],
+                                     packets=scale['packets'])
+    synthetic.generate_camera_dataset(os.path.join(workdir, 'camera', 'dataset', 'data'), frames=scale['frames'],
+                                      width=scale['width'], height=scale['height'])
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the throughput of all stages with the baseline.
+    :return: List of the names of the stages which are slower than the baseline by more than threshold
+    """
+    regressions = []
+    print('{:<26}{:>16}{:>16}{:>10}'.format('stage', 'baseline', 'current', 'ratio'))
+    for name, result in results['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if not base or base.get('status') != 'ok' or result.get('status') != 'ok':
+            print('{:<26}{:>16}{:>16}{:>10}'.format(name, base.get('status', '-') if base else '-',
+                                                    result.get('status'), '-'))
+            continue
+        ratio = result['throughput'] / base['throughput']
+        print('{:<26}{:>16.1f}{:>16.1f}{:>10.2f}'.format(name, base['throughput'], result['throughput'], ratio))
+        if ratio < 1 - threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sensor Emulator Benchmarks")
+    parser.add_argument('--scale', choices=sorted(scales), default='small',
+                        help='Size of the generated synthetic dataset.')
+    parser.add_argument('--scans', type=int, help='Amount of lidar scans (overrides the scale).')
+    parser.add_argument('--packets', type=int, help='Amount of packets per lidar scan (overrides the scale).')
+    parser.add_argument('--frames', type=int, help='Amount of camera frames (overrides the scale).')
+    parser.add_argument('--width', type=int, help='Width of the camera frames (overrides the scale).')
+    parser.add_argument('--height', type=int, help='Height of the camera frames (overrides the scale).')
+    parser.add_argument('--stages', type=str, default=','.join(stage_names),
+                        help='Comma separated list of the stages to run.')
+    parser.add_argument('--output', type=str, default='benchmark_results.json',
+                        help='Path of the json file the results are written to.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Results of an earlier run, the current results are compared against.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative loss of throughput against the baseline, which counts as regression.')
+    parser.add_argument('--workdir', type=str, default=None,
+                        help='Directory of the synthetic data, a temporary directory is used if not given.')
+    parser.add_argument('--run-stage', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage(args.run_stage, args.workdir)
+        return
+
+    scale = dict(scales[args.scale])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='emulator_benchmark_')
+    try:
+        print('Generate synthetic data in {}.'.format(workdir))
+        generate_data(workdir, scale)
+
+        # The optimized LiDAR output has to stay byte-identical to the original implementation
+        checks = check_outputs.run_checks(lidar_dir(workdir), workdir)
+        # The upscaling client is checked against a local stand-in of the service
+        checks.update(('upscale_' + name, failure) for name, failure in upscale_server.run_checks(workdir).items())
+        for name, difference in checks.items():
+            print('check {}: {}'.format(name, 'ok' if difference is None else 'FAILED, ' + difference))
+
+        results = {'meta': {'date': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+                            'platform': platform.platform(), 'cpus': os.cpu_count(), 'scale': scale},
+                   'checks': checks, 'stages': {}}
+        for name in args.stages.split(','):
+            if name not in stage_names:
+                raise Exception("Unknown stage '{}', valid stages are {}.".format(name, ', '.join(stage_names)))
+            result = measure_stage(name, workdir)
+            results['stages'][name] = result
+            if result['status'] == 'ok':
+                print('{}: {:.1f} {}/s, peak RSS {} MB'.format(name, result['throughput'], result['unit'],
+                                                              result.get('peak_rss_kb', 0) // 1024))
+            else:
+                print('{}: {} ({})'.format(name, result['status'], result['reason'].strip().splitlines()[-1]
+                                           if result['reason'].strip() else ''))
+
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Saved to {}.'.format(args.output))
+
+        failed = [name for name, difference in checks.items() if difference is not None]
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline, args.threshold)
+            if regressions:
+                print('Regressions: {}'.format(', '.join(regressions)))
+                sys.exit(1)
+        if failed:
+            print('Failed checks: {}'.format(', '.join(failed)))
+            sys.exit(1)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Generators for synthetic data in the format of the Oxford (Radar) RobotCar Dataset, which is used by the benchmarks.
+"""
+# Imports
+import os
+import cv2
+import numpy as np
+from PIL import Image
+
+# First timestamps of the generated sensors (in microseconds), taken from the oxford dataset
+lidar_start = 1547120787000000
+camera_start = 1418381798113072
+
+
+def encode_velodyne_raw(ranges, intensities, angles, timestamps):
+    """
+    Inverse of LiDAR.load_velodyne_raw. Builds the raw Velodyne image with 32 rows of intensities, 64 rows of
+    ranges (uint16), 2 rows of azimuths (uint16) and 8 rows of timestamps (int64), one column per measurement.
+    :param ranges: Ranges (32 x N)
+    :param intensities: Intensities (32 x N)
+    :param angles: Azimuths (1 x N)
+    :param timestamps: Timestamps of all measurements (1 x N)
+    :return: Image (106 x N) of dtype uint8
+    """
+    def to_rows(array):
+        return np.ascontiguousarray(array.T).view(np.uint8).T
+
+    return np.concatenate([intensities.astype(np.uint8), to_rows(ranges.astype(np.uint16)),
+                           to_rows(angles.astype(np.uint16)), to_rows(timestamps.astype(np.int64))], 0)
+
+
+def generate_velodyne_scan(rng, timestamp, packets=180):
+    """
+    Generates one scan with the given amount of packets (12 measurements per packet).
+    :param rng: numpy random generator
+    :param timestamp: Timestamp of the first measurement in microseconds
+    :param packets: Amount of packets of the scan
+    :return: Raw Velodyne image as expected by LiDAR.load_velodyne_raw
+    """
+    columns = packets * 12
+    ranges = rng.integers(0, 65536, (32, columns), dtype=np.uint16)
+    intensities = rng.integers(0, 256, (32, columns), dtype=np.uint8)
+    angles = ((np.arange(columns) * 36000) // columns).astype(np.uint16)[None]
+    # The HDL-32E sends a packet every 552.96 us
+    timestamps = (timestamp + np.arange(columns) * 553 // 12).astype(np.int64)[None]
+    return encode_velodyne_raw(ranges, intensities, angles, timestamps)
+
+
+def generate_lidar_dataset(data_dir, scans=10, packets=180, name='velodyne_left', seed=0):
+    """
+    Writes '<timestamp>.png' scans and the corresponding '<name>.timestamps' file to data_dir.
+    :param data_dir: Root directory of the dataset (e.g. ./dataset/data/)
+    :param scans: Amount of scans
+    :param packets: Amount of packets per scan
+    :param name: Name of the sensor directory
+    :param seed: Seed of the random generator
+    :return: Path to the sensor directory
+    """
+    rng = np.random.default_rng(seed)
+    sensor_dir = os.path.join(data_dir, name)
+    os.makedirs(sensor_dir, exist_ok=True)
+
+    scan_duration = packets * 553
+    timestamps = [lidar_start + i * scan_duration for i in range(scans)]
+    for timestamp in timestamps:
+        cv2.imwrite(os.path.join(sensor_dir, '{}.png'.format(timestamp)),
+                    generate_velodyne_scan(rng, timestamp, packets))
+    write_timestamps(os.path.join(data_dir, name + '.timestamps'), timestamps)
+    return sensor_dir
+
+
+def generate_bayer_frame(rng, width, height, pattern='gbrg'):
+    """
+    Generates a smooth colour image and mosaics it with the given Bayer pattern, like the raw images of the
+    oxford cameras.
+    :param rng: numpy random generator
+    :param width: Width of the frame
+    :param height: Height of the frame
+    :param pattern: Bayer pattern, 'gbrg' for the stereo and 'rggb' for the mono cameras
+    :return: Grayscale image (H x W) of dtype uint8
+    """
+    small = rng.integers(0, 256, (max(2, height // 32), max(2, width // 32), 3), dtype=np.uint8)
+    rgb = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    channel = {'r': 0, 'g': 1, 'b': 2}
+    bayer = np.empty((height, width), dtype=np.uint8)
+    for i, c in enumerate(pattern):
+        y, x = divmod(i, 2)
+        bayer[y::2, x::2] = rgb[y::2, x::2, channel[c]]
+    return bayer
+
+
+def generate_camera_dataset(data_dir, frames=20, width=1280, height=960, name='stereo/centre', seed=0):
+    """
+    Writes '<timestamp>.png' Bayer frames and the corresponding timestamps file to data_dir.
+    The frames are 62.5 ms (16 Hz) apart with a small random jitter.
+    :param data_dir: Root directory of the dataset (e.g. ./dataset/data/)
+    :param frames: Amount of frames
+    :param width: Width of the frames
+    :param height: Height of the frames
+    :param name: Path of the sensor directory relative to data_dir
+    :param seed: Seed of the random generator
+    :return: Path to the sensor directory
+    """
+    rng = np.random.default_rng(seed)
+    sensor_dir = os.path.join(data_dir, name)
+    os.makedirs(sensor_dir, exist_ok=True)
+
+    pattern = 'gbrg' if 'stereo' in name else 'rggb'
+    timestamps = [camera_start + i * 62500 + int(rng.integers(0, 2000)) for i in range(frames)]
+    for timestamp in timestamps:
+        Image.fromarray(generate_bayer_frame(rng, width, height, pattern)).save(
+            os.path.join(sensor_dir, '{}.png'.format(timestamp)))
+    # As in the oxford dataset, e.g. stereo/centre/*.png and stereo.timestamps
+    write_timestamps(os.path.join(data_dir, name.split('/')[0] + '.timestamps'), timestamps)
+    return sensor_dir
+
+
+def write_timestamps(path, timestamps, chunk=1):
+    """
+    Writes a timestamps file of the oxford dataset ('<timestamp> <chunk>' per line).
+    """
+    with open(path, 'w') as f:
+        for timestamp in timestamps:
+            f.write('{} {}\n'.format(timestamp, chunk))
@@ -0,0 +1,212 @@
+"""
+Local stand-in for the max-image-resolution-enhancer, which upscales png images by 4 (nearest neighbour) and can be
+configured to answer slowly or with server errors. It is used to check the UpscaleClient without the real service:
+
+    python -m benchmarks.upscale_server
+
+The checks are run by run_benchmarks as well.
+"""
+# Imports
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repo_dir not in sys.path:
+    sys.path.insert(0, repo_dir)
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+
+def parse_image(content_type, body):
+    """
+    Extracts the file of the form field 'image' from a multipart/form-data body.
+    :return: Tuple (file name, content) or None if there is no such field
+    """
+    if 'boundary=' not in content_type:
+        return None
+    boundary = content_type.split('boundary=', 1)[1].strip('"').encode()
+    for part in body.split(b'--' + boundary):
+        headers, _, content = part.partition(b'\r\n\r\n')
+        if b'name="image"' not in headers:
+            continue
+        name = headers.split(b'filename="', 1)[1].split(b'"', 1)[0].decode() if b'filename="' in headers else ''
+        return name, content[:-2] if content.endswith(b'\r\n') else content
+    return None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, content=b'', content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        image = parse_image(self.headers.get('Content-Type', ''), body)
+        key = image[0] if image else None
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            attempt = server.attempts[key] = server.attempts.get(key, 0) + 1
+        try:
+            time.sleep(server.delay)
+            if image is None or not image[1].startswith(png_signature):
+                self.respond(400, b'{"status": "error", "message": "No valid png image given."}')
+                return
+            if attempt <= server.failures:
+                self.respond(503)
+                return
+            with Image.open(io.BytesIO(image[1])) as im:
+                upscaled = im.resize((im.size[0] * 4, im.size[1] * 4), Image.NEAREST)
+            output = io.BytesIO()
+            upscaled.save(output, format='png')
+            self.respond(200, output.getvalue(), 'image/png')
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Stand-in for the upscaling service on localhost. It counts the requests and the maximum amount of requests
+    which were handled at the same time.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, delay=0.0, failures=0):
+        """
+        :param port: Port of the server, a free port is chosen if 0
+        :param delay: Time in seconds every request takes
+        :param failures: Amount of requests per image which are answered with status 503 before the image is upscaled
+        """
+        super().__init__(('127.0.0.1', port), StandInHandler)
+        self.delay = delay
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        self.attempts = {}
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{}/model/predict'.format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+def write_images(directory, count, width=16, height=12):
+    """
+    Writes 'count' small png images and returns their paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, '{}.png'.format(1000 + i))
+        Image.new('L', (width, height), i * 16 % 256).save(path)
+        paths.append(path)
+    return paths
+
+
+def run_checks(workdir):
+    """
+    Checks the concurrency, the retries, the handling of client errors and the distribution over several endpoints
+    of the UpscaleClient against stand-in servers.
+    :param workdir: Directory for the images
+    :return: Dictionary of the checks with None if passed, otherwise a description of the failure
+    """
+    from src.UpscaleClient import UpscaleClient
+    results = {}
+    inputs = write_images(os.path.join(workdir, 'upscale_in'), 8)
+
+    def run(name, client, files):
+        output_dir = os.path.join(workdir, 'upscale_' + name)
+        os.makedirs(output_dir)
+        failed = client.upscale_files([(path, os.path.join(output_dir, os.path.basename(path))) for path in files])
+        return failed, sorted(os.listdir(output_dir)), output_dir
+
+    with StandInServer(delay=0.1) as server:
+        failed, written, output_dir = run('concurrency', UpscaleClient(server.endpoint, concurrency=4), inputs)
+        size = None
+        if written:
+            with Image.open(os.path.join(output_dir, written[0])) as im:
+                size = im.size
+        results['concurrency'] = (
+            "{} images failed".format(len(failed)) if failed else
+            "{} images written".format(len(written)) if len(written) != len(inputs) else
+            "upscaled to {}".format(size) if size != (64, 48) else
+            "{} requests in flight instead of 4".format(server.max_active) if server.max_active != 4 else None)
+
+    with StandInServer(failures=2) as server:
+        failed, written, _ = run('retry', UpscaleClient(server.endpoint, concurrency=2, retries=2, backoff=0.01),
+                                 inputs)
+        results['retry'] = (
+            "{} images failed".format(len(failed)) if failed else
+            "{} requests instead of {}".format(server.requests, 3 * len(inputs))
+            if server.requests != 3 * len(inputs) else None)
+
+    with StandInServer(failures=5) as server:
+        failed, written, _ = run('retries_exhausted', UpscaleClient(server.endpoint, retries=1, backoff=0.01),
+                                 inputs)
+        # Neither results nor temporary files may be left behind for the failed images
+        results['retries_exhausted'] = (
+            "{} images failed instead of {}".format(len(failed), len(inputs)) if len(failed) != len(inputs) else
+            "files left behind: {}".format(written) if written else None)
+
+    with StandInServer() as server:
+        invalid = os.path.join(workdir, 'upscale_in', 'invalid.png')
+        with open(invalid, 'wb') as f:
+            f.write(b'not a png')
+        failed, written, _ = run('client_error', UpscaleClient(server.endpoint, retries=3, backoff=0.01), [invalid])
+        results['client_error'] = (
+            "the invalid image did not fail" if len(failed) != 1 else
+            "{} requests, client errors must not be retried".format(server.requests) if server.requests != 1 else
+            "files left behind: {}".format(written) if written else None)
+
+    with StandInServer() as first, StandInServer() as second:
+        failed, _, _ = run('endpoints', UpscaleClient([first.endpoint, second.endpoint], concurrency=2), inputs)
+        results['endpoints'] = (
+            "{} images failed".format(len(failed)) if failed else
+            "requests per endpoint {} and {}".format(first.requests, second.requests)
+            if (first.requests, second.requests) != (len(inputs) // 2, len(inputs) // 2) else None)
+    return results
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='emulator_upscale_')
+    try:
+        results = run_checks(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name, failure in results.items():
+        print('{}: {}'.format(name, 'ok' if failure is None else 'FAILED, ' + failure))
+    if any(failure is not None for failure in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,20 +4,35 @@ import numpy as np
 
 from src import VideoConverter as VC
 from src import ImagePreprocessing as im
+from src import FramePipeline as FP
+from src import FrameCache as FC
+from src import GStreamer as GS
 import argparse
-import subprocess
-from src import LiDAR as LI
-from scapy.utils import wrpcap
+import itertools
+from src import LiDARPool as LP
+from src import DatasetIndex as DI
+from src import Profiler as P
+from src import SyncReplay as SR
+from src.PcapWriter import PcapWriter
+from src.PcapSegments import SegmentedPcapWriter
+from src.UpscaleClient import UpscaleClient
 
 if __name__ == '__main__':
     ''' Start Command Line Arguments Parser '''
     parser = argparse.ArgumentParser(description="Sensor Emulator")
-    parser.add_argument('--sensor', required=True, type=str, choices=['camera', 'lidar'],
+    parser.add_argument('--sensor', required=True, type=str, choices=['camera', 'lidar', 'both'],
                         help='Specify the sensor, which should be emulated.'
-                             'Valid arguments are \'camera\' and \'lidar\'.')
-    parser.add_argument('--frame-rate', type=int, default=25,
+                             'Valid arguments are \'camera\' and \'lidar\'. With \'both\' the cameras are streamed '
+                             '(see --stream) and the lidars replayed (see --replay) together on one clock.')
+    parser.add_argument('--frame-rate', type=float, default=None,
                         help='Specify the framerate (in fps) with which the video should be created out of the '
                              'images. If not given, the timestamps are used to calculate the framerate.')
+    parser.add_argument('--timing', type=str, default=None, choices=['vfr', 'resample', 'fixed'],
+                        help='Timing of the camera video. \'vfr\' shows every image from its timestamp until the '
+                             'next one (variable frame rate), \'resample\' keeps the timing at the constant '
+                             '--frame-rate by blending the images around every frame and \'fixed\' shows every '
+                             'image for 1 / --frame-rate seconds. Defaults to \'fixed\' if --frame-rate is given '
+                             'and \'vfr\' otherwise.')
     parser.add_argument('--rectify', type=str, default='False',
                         help='This options rectifies the image by performing Bayer '
                              'demosaicing and optionally undistorts the image (if '
@@ -28,9 +43,65 @@ if __name__ == '__main__':
                         help='This options scales the images up by 4 using the max-image-resultion.'
                              'It is available under https://github.com/IBM/MAX-Image-Resolution-Enhancer.'
                              'True|False are valid arguments.')
+    parser.add_argument('--upscale-endpoints', type=str, default='http://localhost:5000/model/predict',
+                        help='Comma separated URLs of the predict route of the running max-image-resolution-enhancer '
+                             'services, the requests are distributed over all of them.')
+    parser.add_argument('--upscale-concurrency', type=int, default=4,
+                        help='Amount of upscaling requests in flight at the same time.')
     parser.add_argument('--extension', type=str, default='mp4',
                         help='This option defines the extension of the video produced out of the'
                              'camera raw data. Valid extensions are mp4, avi and all supported by ffmpeg.')
+    parser.add_argument('--encoder', type=str, default=None,
+                        help='ffmpeg video encoder used for the camera video (e.g. libx264, libx265, h264_nvenc). '
+                             'If not given, ffmpeg\'s default for the extension is used.')
+    parser.add_argument('--preset', type=str, default=None,
+                        help='Preset of the video encoder (e.g. ultrafast, medium, veryslow).')
+    parser.add_argument('--frame-cache', type=str, default='./cache/frames/',
+                        help='Directory in which the preprocessed images are cached, keyed by the content of the '
+                             'source image and the preprocessing parameters. The dataset itself is not modified. '
+                             'Pass an empty string to replace the images in the dataset instead.')
+    parser.add_argument('--frame-cache-budget', type=float, default=10,
+                        help='Maximum size of the frame cache in GB, the least recently used frames are removed.')
+    parser.add_argument('--manifest', type=str, default='./dataset/manifest.json',
+                        help='Path of the manifest in which the index of the dataset directory is stored between runs.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Amount of processes used to preprocess the images or to decode and encode the lidar '
+                             'scans in parallel.')
+    parser.add_argument('--scan-cache', type=str, default=None,
+                        help='Directory in which the decoded lidar scans are cached as memory-mapped arrays. '
+                             'Repeated runs on an unchanged dataset then skip decoding the pngs.')
+    parser.add_argument('--replay', type=str, default=None,
+                        help='Only for the lidar. Instead of writing pcaps, the packets are sent via udp to the given '
+                             'ipv4 address (e.g. 255.255.255.255), paced by their timestamps like a live sensor. '
+                             'Every lidar directory i is sent to the ports 2368 + i (data) and 8308 + i (position).')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='Speed multiplier for the replay, e.g. 2 replays twice as fast as recorded.')
+    parser.add_argument('--segment-size', type=float, default=None,
+                        help='Only for the lidar. Write the pcaps as segments of about the given size in MB to '
+                             'out/<sensor>/, each with an index of the Velodyne timestamps. An interrupted run resumes '
+                             'after the last completed segment.')
+    parser.add_argument('--segment-duration', type=float, default=None,
+                        help='Only for the lidar. Like --segment-size, but rotates the segments after the given '
+                             'amount of seconds of Velodyne time.')
+    parser.add_argument('--stream', type=str, default=None,
+                        help='Only for the camera. Instead of creating videos, the frames are streamed as H.264 over '
+                             'RTP to the given comma separated destinations (host or host:port), paced by their '
+                             'timestamps like a live camera. Rectification and resizing are done on the fly.')
+    parser.add_argument('--stream-port', type=int, default=9001,
+                        help='Destination port of the stream for destinations given without port.')
+    parser.add_argument('--stream-speed', type=float, default=1.0,
+                        help='Speed multiplier for the stream, e.g. 2 streams twice as fast as recorded.')
+    parser.add_argument('--stream-bitrate', type=int, default=4000,
+                        help='Bitrate of the stream in kbit/s.')
+    parser.add_argument('--stream-probe', type=int, default=None,
+                        help='Local port to which the stream is sent as well, to measure the end-to-end latency and '
+                             'lost frames.')
+    parser.add_argument('--profile', type=str, nargs='?', const='out/profile.json', default=None,
+                        help='Measure the time, throughput and latency percentiles of every pipeline stage and write '
+                             'them as json to the given path (out/profile.json if no path is given).')
+    parser.add_argument('--progress', type=float, default=0,
+                        help='Only with --profile. Print the amount of items processed per stage every given '
+                             'amount of seconds.')
 
     args = parser.parse_args()
 
@@ -57,45 +128,119 @@ if __name__ == '__main__':
     # Assign command line options to variables
     sensor = args.sensor
     frame_rate = args.frame_rate
+    timing = args.timing
     rectify = args.rectify
     resize_factor = args.resize_factor
     upscale = args.upscale
+    upscale_endpoints = args.upscale_endpoints.split(',')
+    upscale_concurrency = args.upscale_concurrency
     extension = args.extension
+    encoder = args.encoder
+    preset = args.preset
+    workers = args.workers
+    scan_cache = args.scan_cache
+    replay = args.replay
+    replay_speed = args.replay_speed
+    segment_size = int(args.segment_size * 1000000) if args.segment_size else None
+    segment_duration = args.segment_duration
+    segmented = (segment_size or segment_duration) and not replay
+    stream = GS.parse_destinations(args.stream, args.stream_port) if args.stream else None
+    stream_speed = args.stream_speed
+    stream_bitrate = args.stream_bitrate
+    stream_probe = args.stream_probe
+    profile_path = args.profile
     data_dir = "./dataset/data/"
+    manifest_path = args.manifest
+    frame_cache = args.frame_cache
+    frame_cache_budget = int(args.frame_cache_budget * 1e9)
     models_path = "./robotcar_dataset_sdk/models/"  # Path to models of sensors delivered with the oxford dataset
 
+    # Stages are only measured if requested, otherwise the hooks are no-ops.
+    if profile_path:
+        P.enable(args.progress)
+
 
     ##############################################
     ##                  Camera                  ##
     ##############################################
 
-    # Resolve dataset directory to find subdirectories where images (*.pngs) reside
-    sub_dirs = subprocess.check_output("find {} -type f -name *.png | sed -r 's|/[^/]+$||' |sort |uniq".format(data_dir), shell=True).decode("utf-8").split("\n")[:-1]
-    for i, dirs in enumerate(sub_dirs):
-        if not dirs.endswith("/"):
-            sub_dirs[i] = dirs + "/"
-    image_dirs = sub_dirs
-
-    if sensor == 'camera':
-
-        if rectify:
-            print("Rectify images.")
-            for image_dir in image_dirs:
-                im.rectify_images(image_dir, models_path)
-
-        if resize_factor != 1:
-            print("Resize images with factor {}.".format(resize_factor))
-            for image_dir in image_dirs:
-                im.resize_image(image_dir, factor=resize_factor)
+    # Index the dataset directory to find subdirectories where images (*.pngs) reside. Only directories which
+    # changed since the last run are listed again.
+    with P.measure('discovery'):
+        dataset_index = DI.load_index(data_dir, manifest_path)
+    sub_dirs = dataset_index.sensor_dirs()
+    image_dirs = [dirs if dirs.endswith("/") else dirs + "/" for dirs in sub_dirs]
 
-        if upscale:
-            print("Upscale images.")
-            for image_dir in image_dirs:
-                im.upscale_image(image_dir)
+    if sensor == 'camera' and stream and not upscale:
 
-        print("Convert images to video.")
+        # Frames are rectified and resized in memory while they are streamed, nothing is written to disk.
         for image_dir in image_dirs:
-            VC.convert_to_video(image_dir, frame_rate=frame_rate, video_ext=extension)
+            print("Stream {} to {}.".format(image_dir, args.stream))
+            stats = GS.stream_images(image_dir, stream, models_path if rectify else None, rectify=rectify,
+                                     factor=resize_factor, speed=stream_speed, bitrate=stream_bitrate,
+                                     probe_port=stream_probe, workers=workers)
+            print(GS.format_statistics(stats))
+
+    elif sensor == 'camera':
+
+        # Directories from which the videos are created
+        video_dirs = image_dirs
+
+        if frame_cache and (rectify or resize_factor != 1 or upscale):
+            # Processed frames are written to the cache and the dataset is left untouched. Frames which were
+            # processed with the same parameters by an earlier run are reused.
+            if rectify:
+                print("Rectify images.")
+            if resize_factor != 1:
+                print("Resize images with factor {}.".format(resize_factor))
+            if upscale:
+                print("Upscale images.")
+            cache = FC.FrameCache(frame_cache, frame_cache_budget)
+            upscale_client = UpscaleClient(upscale_endpoints, concurrency=upscale_concurrency) if upscale else None
+            video_dirs = [FC.preprocess_cached(cache, image_dir, dataset_index.relative(image_dir),
+                                               models_path if rectify else None, rectify=rectify, factor=resize_factor,
+                                               upscale_client=upscale_client, workers=workers)
+                          for image_dir in image_dirs]
+            removed, cache_size = cache.evict()
+            cache.save()
+            if cache.hits or cache.misses:
+                print("Frame cache: {} reused, {} processed, {} evicted, {:.1f} MB.".format(
+                    cache.hits, cache.misses, removed, cache_size / 1e6))
+
+        else:
+            # Rectification and resizing are done in a single pass over the frames, which are replaced.
+            if rectify or resize_factor != 1:
+                if rectify:
+                    print("Rectify images.")
+                if resize_factor != 1:
+                    print("Resize images with factor {}.".format(resize_factor))
+                for image_dir in image_dirs:
+                    FP.preprocess_images(image_dir, models_path if rectify else None, rectify=rectify,
+                                         factor=resize_factor, workers=workers)
+
+            if upscale:
+                print("Upscale images.")
+                for image_dir in image_dirs:
+                    im.upscale_image(image_dir, endpoints=upscale_endpoints, concurrency=upscale_concurrency)
+
+        if stream:
+            # The upscaled images are streamed as they are
+            for image_dir in video_dirs:
+                print("Stream {} to {}.".format(image_dir, args.stream))
+                stats = GS.stream_images(image_dir, stream, speed=stream_speed, bitrate=stream_bitrate,
+                                         probe_port=stream_probe, workers=workers)
+                print(GS.format_statistics(stats))
+        else:
+            print("Convert images to video.")
+            # The timestamps files belong to the directories in the dataset, the frames may be read from the cache
+            for image_dir, video_dir in zip(image_dirs, video_dirs):
+                VC.convert_to_video(video_dir, frame_rate=frame_rate, video_ext=extension, encoder=encoder,
+                                    preset=preset, timing=timing,
+                                    timestamps_path=dataset_index.timestamps_file(image_dir, enclosing=True))
+
+    if sensor == 'camera' and profile_path:
+        P.write_summary(profile_path)
+        print('Profile saved to {}.'.format(profile_path))
 
 
 
@@ -103,76 +248,163 @@ if __name__ == '__main__':
     ##                  LiDAR                   ##
     ##############################################
 
+    # Payload of the position packets of the HDL-32E, which are sent between the data packets
+    position_packet_payload = b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xba\x0f\x47\x10\x20\x23\x17\x30\xf4\x0f\x56\x10\x1e\x23\xae\x3f\xc7\x0e\x6d\x10\xf1\x2f\xad\x3f\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x94\xaa\xac\x17\x00\x00\x00\x00\x24\x47\x50\x52\x4d\x43\x2c\x32\x32\x30\x36\x33\x36\x2c\x41\x2c\x33\x37\x30\x37\x2e\x38\x33\x32\x33\x2c\x4e\x2c\x31\x32\x31\x33\x39\x2e\x32\x38\x36\x33\x2c\x57\x2c\x30\x30\x33\x2e\x32\x2c\x31\x34\x35\x2e\x37\x2c\x31\x31\x31\x32\x31\x32\x2c\x30\x31\x33\x2e\x38\x2c\x45\x2c\x44\x2a\x30\x44\x0d\x0a\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
     if sensor == 'lidar':
 
-        position_packet_payload = b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xba\x0f\x47\x10\x20\x23\x17\x30\xf4\x0f\x56\x10\x1e\x23\xae\x3f\xc7\x0e\x6d\x10\xf1\x2f\xad\x3f\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x94\xaa\xac\x17\x00\x00\x00\x00\x24\x47\x50\x52\x4d\x43\x2c\x32\x32\x30\x36\x33\x36\x2c\x41\x2c\x33\x37\x30\x37\x2e\x38\x33\x32\x33\x2c\x4e\x2c\x31\x32\x31\x33\x39\x2e\x32\x38\x36\x33\x2c\x57\x2c\x30\x30\x33\x2e\x32\x2c\x31\x34\x35\x2e\x37\x2c\x31\x31\x31\x32\x31\x32\x2c\x30\x31\x33\x2e\x38\x2c\x45\x2c\x44\x2a\x30\x44\x0d\x0a\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
         position_packet_counter = 1
         set_pps = False
         pps_list = []
 
-        # Resolve dataset directory to find subdirectories where png's reside.
-        lidar_dirs = subprocess.check_output(
-            "find {} -type f -name *.png | sed -r 's|/[^/]+$||' |sort |uniq".format(data_dir), shell=True).decode(
-            "utf-8").split("\n")[:-1]
-        for i, dirs in enumerate(sub_dirs):
-            if not dirs.endswith("/"):
-                sub_dirs[i] = dirs + "/"
+        # Subdirectories where png's reside.
+        lidar_dirs = sub_dirs
 
         # Find correspondent timestamps-files to directories where lidar-pngs reside.
         timestamps_dirs = []
         for dir in lidar_dirs:
-            timestamps_name = str(os.path.basename(os.path.normpath(dir))) + '.timestamps'
-            timestamps_path = subprocess.check_output(
-                "find {} -type f -name {}".format(
-                    data_dir, timestamps_name), shell=True).decode("utf-8").split("\n")[:-1]
-            if timestamps_path != []:
-                timestamps_dirs.append(timestamps_path[0])
+            timestamps_path = dataset_index.timestamps_file(dir)
+            if timestamps_path is not None:
+                timestamps_dirs.append(timestamps_path)
             else:
-                raise Exception("Timestamps file {} not found.".format(timestamps_name))
+                raise Exception("Timestamps file {} not found.".format(
+                    str(os.path.basename(os.path.normpath(dir))) + '.timestamps'))
 
-        # Iterate over found lidar directories and process the data to Velodyne HDL-32E packets.
+        # Load timestamps of all directories to resolve the scans, which are to be encoded.
+        scan_files = []
         for i in range(len(lidar_dirs)):
+            timestamps = np.loadtxt(timestamps_dirs[i], delimiter=' ', usecols=[0], dtype=np.int64, ndmin=1)
+            scan_files.append([os.path.join(lidar_dirs[i], str(l_timestamp) + '.png') for l_timestamp in timestamps])
+
+        if replay:
+            # The packets are sent via udp like live sensors would do. Every directory gets its own pair of ports
+            # (2368 + i, 8308 + i) and all of them are paced by one clock, like the lidars of the vehicle.
+            sources = []
+            for i in range(len(lidar_dirs)):
+                sensor_pos = os.path.basename(os.path.normpath(lidar_dirs[i]))
+                print('Replay {} to {}:{} and {}:{}.'.format(sensor_pos, replay, 2368 + i, replay, 8308 + i))
+                sources.append(SR.LidarSource(sensor_pos, scan_files[i], replay, 2368 + i, 8308 + i,
+                                              position_packet_payload, workers=workers, cache_dir=scan_cache))
+            for name, stats in SR.replay(sources, speed=replay_speed).items():
+                print(SR.format_statistics(name, stats))
+
+        else:
+            # Segmented pcaps are resumed after the last completed segment, so its scans are not encoded again.
+            if segmented:
+                segment_writers = []
+                for i in range(len(lidar_dirs)):
+                    sensor_pos = os.path.basename(lidar_dirs[i])
+                    segment_writers.append(SegmentedPcapWriter(os.path.join('out', sensor_pos), sensor_pos,
+                                                               segment_size, segment_duration))
+                    skip = segment_writers[i].resume(scan_files[i])
+                    if skip:
+                        print('Resume {} after {} of {} scans.'.format(sensor_pos, skip, len(scan_files[i])))
+                    scan_files[i] = scan_files[i][skip:]
+
+            # Scans of all directories are encoded (in parallel if workers > 1), but returned in their original order.
+            scans = LP.encode_scans(itertools.chain(*scan_files), workers=workers, cache_dir=scan_cache)
+
+            # Iterate over found lidar directories and process the data to Velodyne HDL-32E packets.
+            for i in range(len(lidar_dirs)):
+
+                # Get name of directory to store pcaps later with this name
+                sensor_pos = os.path.basename(lidar_dirs[i])
+
+                if segmented:
+                    # Packets of a directory are written to rotating segments in out/<sensor>/.
+                    writer = segment_writers[i]
+                    out_path = os.path.join('out', sensor_pos)
+                    position_frame = writer.build_frame(position_packet_payload, udp_s=8308, udp_d=8308)
+                    # The position packets continue where the completed segments end
+                    position_packet_counter += writer.packets
+                else:
+                    # Packets of a directory are streamed to out/ directory as they are created.
+                    if not os.path.exists('out'):
+                        os.makedirs('out')
+                    out_path = 'out/{}.pcap'.format(sensor_pos)
+                    writer = PcapWriter(out_path)
+
+                    # The position packet is constant, so its frame is only built once
+                    position_frame = writer.build_frame(position_packet_payload, udp_s=8308, udp_d=8308)
+
+                # Iterate over the scans of the directory
+                for scan_file in scan_files[i]:
+
+                    # Get the encoded payloads of all packets that can be created from the scan
+                    payloads, timestamp = next(scans)
+                    if segmented:
+                        writer.begin_scan(scan_file)
+
+                    # Write packets
+                    for p, payload in enumerate(payloads):
+                        # The ratio of data to position packets is 14:1, so every 15th packet is a position packet.
+                        if position_packet_counter % 15 == 0:
+                            if segmented:
+                                writer.write_frame(position_frame, int(timestamp[0, p]))
+                            else:
+                                writer.write_frame(position_frame)
+
+                        # Creation of data packet
+                        if segmented:
+                            writer.write(payload, int(timestamp[0, p]))
+                        else:
+                            writer.write(payload)
+                        position_packet_counter += 1
+
+                    if segmented:
+                        writer.end_scan()
+
+                if segmented:
+                    writer.close()
+                    print('Saved {} segments to {}.'.format(len(writer.segments), out_path))
+                else:
+                    writer.close()
+                    print('Saved to {}.'.format(out_path))
+
+            scans.close()
+        if profile_path:
+            P.write_summary(profile_path)
+            print('Profile saved to {}.'.format(profile_path))
+        print('End.')
 
-            packets = []    # Variable to store all packets created out of one directory
-
-            # Get name of directory to store pcaps later with this name
-            sensor_pos = os.path.basename(lidar_dirs[i])
-
-            # Load timestamps
-            timestamps = np.loadtxt(timestamps_dirs[i], delimiter=' ', usecols=[0], dtype=np.int64)
-
-            # Iterate over timestamps
-            for l_timestamp in timestamps:
-                filename = os.path.join(lidar_dirs[0], str(l_timestamp) + '.png')
-
-                # Get raw packet content
-                ranges, intensities, angles, timestamp = LI.load_velodyne_raw(filename)
-
-                # Calculate amount of packets that can be created from the loaded data
-                num_packets = timestamp.shape[1]
-
-                # Build packets
-                for i in range(num_packets):
-                    # The ratio of data to position packets is 14:1, so every 15th packet is a position packet.
-                    if position_packet_counter % 15 == 0:
-                        position_packet = LI.build_packet(position_packet_payload, udp_s=8308, udp_d=8308)
-                        packets.append(position_packet)
 
-                    # Creation of data packet
-                    pkt_ranges = ranges[:, i * 12:i * 12 + 12]
-                    pkt_intensities = intensities[:, i * 12:i * 12 + 12]
-                    pkt_angles = angles[:, i * 12:i * 12 + 12]
-                    pkt_timestamp = timestamp[:, i]
-                    payload = LI.create_velodyne_payload(pkt_ranges, pkt_intensities, pkt_angles, pkt_timestamp)
-                    packet = LI.build_packet(payload)
-                    position_packet_counter += 1
-                    packets.append(packet)
 
-            # Store all created packets of a directory to out/ directory.
-            if not os.path.exists('out'):
-                os.makedirs('out')
-            out_path = 'out/{}.pcap'.format(sensor_pos)
-            wrpcap(out_path, packets)
-            print('Saved to {}.'.format(out_path))
+    ##############################################
+    ##         Synchronized Replay              ##
+    ##############################################
 
+    if sensor == 'both':
+
+        if not replay or not stream:
+            raise Exception("The synchronized replay needs the lidar destination (--replay) and the camera "
+                            "destinations (--stream).")
+
+        # Velodyne directories are replayed as lidars, all other directories with pngs are streamed as cameras.
+        # Every lidar gets its own pair of ports (2368 + i, 8308 + i), every camera the stream ports + i.
+        sources = []
+        lidar_dirs = [d for d in sub_dirs if os.path.basename(os.path.normpath(d)).startswith('velodyne')]
+        for i, lidar_dir in enumerate(lidar_dirs):
+            timestamps_path = dataset_index.timestamps_file(lidar_dir)
+            if timestamps_path is None:
+                raise Exception("Timestamps file {} not found.".format(
+                    os.path.basename(os.path.normpath(lidar_dir)) + '.timestamps'))
+            timestamps = np.loadtxt(timestamps_path, delimiter=' ', usecols=[0], dtype=np.int64, ndmin=1)
+            sources.append(SR.LidarSource(os.path.basename(os.path.normpath(lidar_dir)),
+                                          [os.path.join(lidar_dir, str(t) + '.png') for t in timestamps],
+                                          replay, 2368 + i, 8308 + i, position_packet_payload, workers=workers,
+                                          cache_dir=scan_cache))
+        camera_dirs = [d for d in image_dirs if d.rstrip('/') not in lidar_dirs]
+        for i, image_dir in enumerate(camera_dirs):
+            sources.append(SR.CameraSource(dataset_index.relative(image_dir), image_dir,
+                                           [(host, port + i) for host, port in stream],
+                                           models_path if rectify else None, rectify=rectify, factor=resize_factor,
+                                           workers=workers, bitrate=stream_bitrate,
+                                           timestamps_path=dataset_index.timestamps_file(image_dir, enclosing=True)))
+
+        print('Replay {} sensors together.'.format(len(sources)))
+        for name, stats in SR.replay(sources, speed=replay_speed).items():
+            print(SR.format_statistics(name, stats))
+        if profile_path:
+            P.write_summary(profile_path)
+            print('Profile saved to {}.'.format(profile_path))
         print('End.')
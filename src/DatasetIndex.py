@@ -0,0 +1,150 @@
+# Imports
+import json
+import os
+
+manifest_version = 1
+
+
+class DatasetIndex:
+    """
+    Index of the dataset directory tree. It maps every directory to its png frames and .timestamps files and is
+    persisted as json manifest. On a refresh only directories whose mtime changed are listed again, the others
+    are only stat'ed, so the cost grows with the amount of directories instead of the amount of files.
+    """
+
+    def __init__(self, root, manifest_path=None):
+        """
+        :param root: Root directory of the dataset (e.g. ./dataset/data/)
+        :param manifest_path: Path of the json manifest, the index is not persisted if not given
+        """
+        self.root = root
+        self.manifest_path = manifest_path
+        self.dirs = {}      # Relative path -> {'mtime_ns', 'subdirs', 'frames', 'timestamps'}
+
+        if manifest_path and os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == manifest_version and manifest.get('root') == os.path.abspath(root):
+                    self.dirs = manifest['dirs']
+            except (OSError, ValueError, KeyError):
+                self.dirs = {}
+
+    def refresh(self):
+        """
+        Brings the index up to date with the directory tree.
+        :return: Amount of directories which had to be listed again or have been removed
+        """
+        dirs = {}
+        rescanned = 0
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.root, rel)
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            entry = self.dirs.get(rel)
+            if entry is None or entry['mtime_ns'] != mtime_ns:
+                entry = scan_dir(path, mtime_ns)
+                rescanned += 1
+            dirs[rel] = entry
+            stack.extend(os.path.join(rel, subdir) for subdir in entry['subdirs'])
+
+        removed = len(set(self.dirs) - set(dirs))
+        self.dirs = dirs
+        return rescanned + removed
+
+    def save(self):
+        """
+        Writes the manifest. A dataset on a read-only file system is only indexed in memory.
+        """
+        if not self.manifest_path:
+            return
+        manifest = {'version': manifest_version, 'root': os.path.abspath(self.root), 'dirs': self.dirs}
+        tmp_path = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+        try:
+            directory = os.path.dirname(self.manifest_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError:
+            pass
+
+    def sensor_dirs(self):
+        """
+        :return: Sorted list of the paths (relative to the working directory) of all directories containing pngs
+        """
+        return sorted(os.path.join(self.root, rel) for rel, entry in self.dirs.items() if entry['frames'])
+
+    def frames(self, directory):
+        """
+        :param directory: Path of a sensor directory as returned by sensor_dirs
+        :return: Sorted list of the names of the png frames in the directory
+        """
+        return self.dirs[self.relative(directory)]['frames']
+
+    def timestamps_file(self, directory, enclosing=False):
+        """
+        Finds the timestamps file of a sensor directory (<directory name>.timestamps) anywhere in the dataset. A file
+        next to the directory is preferred.
+        :param directory: Path of a sensor directory as returned by sensor_dirs
+        :param enclosing: If there is no such file, use the file of an enclosing directory, e.g. stereo.timestamps
+                          for stereo/centre as in the oxford dataset. Only cameras are stored like this, lidar
+                          directories have to be found by their own name.
+        :return: Path to the timestamps file or None if there is none
+        """
+        rel = self.relative(directory)
+        while rel:
+            name = os.path.basename(rel) + '.timestamps'
+            parent = os.path.dirname(rel)
+            if name in self.dirs.get(parent, {}).get('timestamps', []):
+                return os.path.join(self.root, parent, name)
+            for rel_dir in sorted(self.dirs):
+                if name in self.dirs[rel_dir]['timestamps']:
+                    return os.path.join(self.root, rel_dir, name)
+            if not enclosing:
+                break
+            rel = parent
+        return None
+
+    def relative(self, directory):
+        rel = os.path.relpath(directory, self.root)
+        return '' if rel == '.' else rel
+
+
+def scan_dir(path, mtime_ns):
+    """
+    Lists one directory with os.scandir.
+    :param path: Path to the directory
+    :param mtime_ns: mtime of the directory, stored to detect changes
+    :return: Index entry of the directory
+    """
+    subdirs, frames, timestamps = [], [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.name.endswith('.png') and entry.is_file():
+                frames.append(entry.name)
+            elif entry.name.endswith('.timestamps') and entry.is_file():
+                timestamps.append(entry.name)
+    return {'mtime_ns': mtime_ns, 'subdirs': sorted(subdirs), 'frames': sorted(frames),
+            'timestamps': sorted(timestamps)}
+
+
+def load_index(root, manifest_path=None):
+    """
+    Loads the manifest of the dataset, refreshes it and writes it back.
+    :param root: Root directory of the dataset
+    :param manifest_path: Path of the json manifest
+    :return: Up-to-date DatasetIndex
+    """
+    index = DatasetIndex(root, manifest_path)
+    if index.refresh():
+        index.save()
+    return index
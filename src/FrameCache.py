@@ -0,0 +1,250 @@
+# Imports
+import hashlib
+import json
+import os
+import shutil
+from src import FramePipeline as FP
+from src import ImagePreprocessing as im
+from src import Profiler as P
+
+cache_version = 1
+sources_name = 'sources.json'
+
+
+class FrameCache:
+    """
+    Content-addressed cache of preprocessed frames. An entry is keyed by the hash of the content of the source frame
+    and the chain of stages (with their parameters) applied to it, so the source frames are never modified and every
+    combination of parameters is computed once. Entries are evicted in least-recently-used order (by their mtime,
+    which is updated on every use) once the cache exceeds its disk budget.
+    """
+
+    def __init__(self, cache_dir, budget=None):
+        """
+        :param cache_dir: Root directory of the cache
+        :param budget: Maximum size of the cached frames in bytes, unlimited if not given
+        """
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.entries_dir = os.path.join(cache_dir, 'entries')
+        self.views_dir = os.path.join(cache_dir, 'views')
+        self.sources_path = os.path.join(cache_dir, sources_name)
+        os.makedirs(self.entries_dir, exist_ok=True)
+
+        # Hashes of the source frames, keyed by their absolute path and only valid for the stored size and mtime,
+        # so unchanged frames are not read again to be hashed
+        self.sources = {}
+        try:
+            with open(self.sources_path) as f:
+                sources = json.load(f)
+            if sources.get('version') == cache_version:
+                self.sources = sources['sources']
+        except (OSError, ValueError, KeyError):
+            pass
+        self.sources_changed = False
+
+        # Entries used by this run, which are not evicted
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+
+    def source_hash(self, path):
+        """
+        :param path: Path to a source frame
+        :return: sha1 of the content of the frame
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.sources.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        with P.measure('source hash', nbytes=stat.st_size):
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+        self.sources[path] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+        self.sources_changed = True
+        return sha1.hexdigest()
+
+    def entry_path(self, source_hash, chain):
+        """
+        :param source_hash: Hash of the source frame as returned by source_hash
+        :param chain: List of the stages applied to the source frame, see stage_chain
+        :return: Path of the cache entry
+        """
+        key = hashlib.sha1(json.dumps({'version': cache_version, 'source': source_hash, 'chain': chain},
+                                      sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.entries_dir, key[:2], key + '.png')
+
+    def lookup(self, path, count=True):
+        """
+        Marks the entry as used by this run if it exists.
+        :param path: Path of the entry as returned by entry_path
+        :param count: Count the lookup in hits and misses, False for intermediate entries of a frame
+        :return: True if the entry exists
+        """
+        self.pinned.add(path)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += count
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return False
+        self.hits += count
+        return True
+
+    def view(self, name, chain, frames):
+        """
+        Creates a directory of symlinks named like the source frames ('<timestamp>.png') to their entries, which
+        can be read like the original directory, e.g. by VideoConverter. The view is recreated on every run.
+        :param name: Relative path of the camera directory, e.g. stereo/centre
+        :param chain: Chain of stages of the entries
+        :param frames: List of tuples (name of the frame, path of its entry)
+        :return: Path of the view directory (with trailing slash)
+        """
+        chain_key = hashlib.sha1(json.dumps(chain, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        view_dir = os.path.join(self.views_dir, chain_key, name)
+        if os.path.isdir(view_dir):
+            shutil.rmtree(view_dir)
+        os.makedirs(view_dir)
+        for image_name, entry in frames:
+            os.symlink(os.path.abspath(entry), os.path.join(view_dir, image_name))
+        return view_dir + '/'
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits into its budget. Entries used by this run are
+        kept, even if they alone exceed the budget.
+        :return: Tuple (amount of removed entries, size of the cache in bytes)
+        """
+        entries = []
+        total = 0
+        for prefix in os.scandir(self.entries_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name.startswith('.'):
+                    continue    # Frame which is written right now
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, entry.path, stat.st_size))
+                total += stat.st_size
+        if self.budget is None or total <= self.budget:
+            return 0, total
+
+        removed = 0
+        for _, path, size in sorted(entries):
+            if total <= self.budget:
+                break
+            if path in self.pinned:
+                continue
+            os.remove(path)
+            total -= size
+            removed += 1
+        return removed, total
+
+    def save(self):
+        """
+        Writes the hashes of the source frames.
+        """
+        if not self.sources_changed:
+            return
+        # Forget the hashes of source frames which do not exist anymore
+        self.sources = {path: known for path, known in self.sources.items() if os.path.exists(path)}
+        tmp_path = "{}.{}.tmp".format(self.sources_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': cache_version, 'sources': self.sources}, f)
+        os.replace(tmp_path, self.sources_path)
+        self.sources_changed = False
+
+
+def model_hash(model_path, name):
+    """
+    :param model_path: Path to the camera models
+    :param name: Name of the camera model as returned by ImagePreprocessing.model_name, e.g. stereo_wide_left
+    :return: sha1 of the intrinsics and the distortion lookup table of the camera model
+    """
+    sha1 = hashlib.sha1()
+    for file_name in (name + '.txt', name + '_distortion_lut.bin'):
+        path = os.path.join(model_path, file_name)
+        if os.path.isfile(path):
+            sha1.update(file_name.encode('utf-8'))
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+    return sha1.hexdigest()
+
+
+def stage_chain(model_path=None, rectify=False, factor=None, size=None, upscale=False, image_path=None, name=None):
+    """
+    Describes the stages applied to a frame, in the order of FramePipeline.FrameProcessor and the upscaling.
+    :param image_path: Path to the camera directory, needed to determine the camera model for rectify
+    :param name: Relative path of the camera directory, e.g. stereo/centre
+    :return: List of stages with their parameters
+    """
+    chain = []
+    if rectify:
+        # The Bayer pattern and the camera model are chosen by the path of the camera, so byte-identical frames
+        # of two cameras are rectified differently. The model is identified by the content of its files, the
+        # remap tables stored next to them (see ImagePreprocessing.load_undistortion_maps) are derived from them.
+        stage = {'stage': 'rectify', 'camera': name, 'model': None}
+        if model_path:
+            stage['model'] = im.model_name(FP.CameraModel(model_path, image_path))
+            stage['model_sha1'] = model_hash(model_path, stage['model'])
+        chain.append(stage)
+    if size:
+        chain.append({'stage': 'resize', 'size': list(size)})
+    elif factor and factor != 1:
+        chain.append({'stage': 'resize', 'factor': factor})
+    if upscale:
+        chain.append({'stage': 'upscale', 'service': 'max-image-resolution-enhancer'})
+    return chain
+
+
+def preprocess_cached(cache, image_path, name, model_path=None, rectify=False, factor=None, size=None,
+                      upscale_client=None, workers=1):
+    """
+    Preprocesses the frames of a camera directory into the cache, without modifying them. Only the frames whose
+    entries are missing are processed, the others are reused.
+    :param cache: FrameCache
+    :param image_path: Path to the directory where the images reside
+    :param name: Relative path of the camera directory, e.g. stereo/centre
+    :param model_path: Path to the camera models that are contained in the robotcar_dataset_sdk
+    :param rectify: Perform Bayer demosaicing and undistortion
+    :param factor: factor to scale images up and down
+    :param size: explicit size of the form (W, H), to which the images should be resized
+    :param upscale_client: UpscaleClient, the frames are not upscaled if not given
+    :param workers: Amount of processes used for rectification and resizing
+    :return: Path to the view directory of the processed frames (see FrameCache.view), image_path if no stage
+             was requested
+    """
+    chain = stage_chain(model_path, rectify, factor, size, False, image_path, name)
+    full_chain = chain + stage_chain(upscale=upscale_client is not None)
+    if not full_chain:
+        return image_path
+
+    image_list = FP.list_images(image_path)
+    sources = [os.path.join(image_path, image_name) for image_name in image_list]
+    with P.measure('cache lookup', items=len(image_list)):
+        hashes = [cache.source_hash(source) for source in sources]
+        entries = [cache.entry_path(source_hash, full_chain) for source_hash in hashes]
+        missing = [i for i, entry in enumerate(entries) if not cache.lookup(entry)]
+
+    if upscale_client is None:
+        FP.preprocess_files([(sources[i], entries[i]) for i in missing], image_path, model_path, rectify, factor,
+                            size, workers)
+        return cache.view(name, full_chain, list(zip(image_list, entries)))
+
+    # The rectified and resized frames are cached as well, so the upscaling starts from them. Without these
+    # stages the source frames are upscaled.
+    inputs = {i: sources[i] for i in missing}
+    if chain:
+        inputs = {i: cache.entry_path(hashes[i], chain) for i in missing}
+        FP.preprocess_files([(sources[i], inputs[i]) for i in missing if not cache.lookup(inputs[i], count=False)],
+                            image_path, model_path, rectify, factor, size, workers)
+
+    failed = upscale_client.upscale_files((inputs[i], entries[i]) for i in missing)
+    if failed:
+        raise Exception("Upscaling of {} of {} images failed, e.g. {}: {}".format(
+            len(failed), len(missing), failed[0][0], failed[0][1]))
+    return cache.view(name, full_chain, list(zip(image_list, entries)))
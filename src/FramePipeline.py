@@ -0,0 +1,195 @@
+# Imports
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from src import ImagePreprocessing as im
+from src import Profiler as P
+from robotcar_dataset_sdk.python.camera_model import CameraModel
+
+# Processor of the current worker process, created once by the pool initializer
+worker_processor = None
+
+
+class FrameProcessor:
+    """
+    Chains all preprocessing stages (rectification and resizing) of one frame in memory, so every frame is decoded
+    once and written at most once.
+    """
+
+    def __init__(self, image_path, model_path=None, rectify=False, factor=None, size=None):
+        """
+        :param image_path: Path to the directory where the images reside
+        :param model_path: Path to the camera models that are contained in the robotcar_dataset_sdk
+        :param rectify: Perform Bayer demosaicing and undistortion (see ImagePreprocessing.rectify_images)
+        :param factor: factor to scale images up and down
+        :param size: explicit size of the form (W, H), to which the images should be resized
+        """
+        if factor and size:
+            raise Exception("Only one parameter, either 'factor' or 'size', must be specified.")
+
+        self.rectify = rectify
+        self.factor = factor if factor != 1 else None
+        self.size = size
+        self.model = None
+        self.model_path = model_path
+        if rectify and model_path:
+            self.model = CameraModel(model_path, image_path)
+
+    def process(self, image_file):
+        """
+        Loads and processes one frame.
+        :param image_file: Path to the image
+        :return: Processed frame as numpy array
+        """
+        if self.rectify:
+            frame = im.rectify_frame(image_file, self.model, self.model_path)
+        else:
+            with P.measure('png decode') as m:
+                with Image.open(image_file) as f:
+                    frame = np.array(f)
+                m.nbytes = frame.nbytes
+
+        if self.factor or self.size:
+            with P.measure('resize', nbytes=frame.nbytes):
+                frame = np.array(im.resize_frame(Image.fromarray(frame), factor=self.factor, size=self.size))
+        return frame
+
+
+def init_worker(processor_args, profile=False):
+    global worker_processor
+    P.init_worker(profile)
+    worker_processor = FrameProcessor(*processor_args)
+
+
+def process_and_save(image_file, output_file):
+    save_frame(worker_processor, image_file, output_file)
+    return P.take()
+
+
+def process_frame(image_file):
+    return worker_processor.process(image_file), P.take()
+
+
+def save_frame(processor, image_file, output_file):
+    """
+    Processes one frame with the given processor and writes it as png. The png is written to a hidden temporary
+    file first, so an interrupted run never leaves a truncated frame behind.
+    """
+    frame = processor.process(image_file)
+    directory, name = os.path.split(output_file)
+    tmp_file = os.path.join(directory, ".{}.{}.tmp".format(name, os.getpid()))
+    with P.measure('png write', nbytes=frame.nbytes):
+        Image.fromarray(frame).save(tmp_file, format="png")
+        os.replace(tmp_file, output_file)
+
+
+def list_images(image_path):
+    """
+    :param image_path: Path to the directory where the images reside
+    :return: Sorted list of the names of all non-hidden files of the directory
+    """
+    return sorted(x for x in os.listdir(image_path) if not x.startswith('.'))
+
+
+def preprocess_images(image_path, model_path=None, rectify=False, factor=None, size=None, output_path=None,
+                      workers=1, prefetch=None):
+    """
+    Preprocesses all images of a directory in a single pass. Rectification and resizing are done in memory, so each
+    frame is decoded once and written once. With workers > 1 the frames are spread over a process pool, of which
+    at most 'prefetch' frames are in flight at the same time.
+    :param image_path: Path to the directory where the images reside
+    :param model_path: Path to the camera models that are contained in the robotcar_dataset_sdk
+    :param rectify: Perform Bayer demosaicing and undistortion (see ImagePreprocessing.rectify_images)
+    :param factor: factor to scale images up and down
+    :param size: explicit size of the form (W, H), to which the images should be resized
+    :param output_path: Directory to which the processed images are written, the images are replaced if not given
+    :param workers: Amount of processes
+    :param prefetch: Maximum amount of frames in flight, 2 * workers if not given
+    """
+    if output_path is None:
+        output_path = image_path
+    os.makedirs(output_path, exist_ok=True)
+    files = [(os.path.join(image_path, image_name), os.path.join(output_path, image_name))
+             for image_name in list_images(image_path)]
+    preprocess_files(files, image_path, model_path, rectify, factor, size, workers, prefetch)
+
+
+def preprocess_files(files, image_path, model_path=None, rectify=False, factor=None, size=None, workers=1,
+                     prefetch=None):
+    """
+    Preprocesses the given images of one camera, see preprocess_images.
+    :param files: List of tuples (path of the image, path of the processed image)
+    :param image_path: Path to the directory of the camera, from which the camera model is derived
+    :param model_path: Path to the camera models that are contained in the robotcar_dataset_sdk
+    :param rectify: Perform Bayer demosaicing and undistortion (see ImagePreprocessing.rectify_images)
+    :param factor: factor to scale images up and down
+    :param size: explicit size of the form (W, H), to which the images should be resized
+    :param workers: Amount of processes
+    :param prefetch: Maximum amount of frames in flight, 2 * workers if not given
+    """
+    processor_args = (image_path, model_path, rectify, factor, size)
+
+    if workers <= 1:
+        processor = FrameProcessor(*processor_args)
+        for image_file, output_file in files:
+            save_frame(processor, image_file, output_file)
+        return
+
+    if prefetch is None:
+        prefetch = 2 * workers
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(processor_args, P.enabled)) as executor:
+        for image_file, output_file in files:
+            if len(pending) >= prefetch:
+                P.merge(pending.popleft().result())
+            pending.append(executor.submit(process_and_save, image_file, output_file))
+        while pending:
+            P.merge(pending.popleft().result())
+
+
+def process_frames(image_path, image_list, model_path=None, rectify=False, factor=None, size=None, workers=1,
+                   prefetch=None):
+    """
+    Generator yielding the processed frames in memory instead of writing them, e.g. to stream them. With
+    workers > 1 up to 'prefetch' frames are processed ahead by a process pool, the frames are yielded in order.
+    :param image_path: Path to the directory where the images reside
+    :param image_list: Names of the images in the order in which they are yielded
+    :param model_path: Path to the camera models that are contained in the robotcar_dataset_sdk
+    :param rectify: Perform Bayer demosaicing and undistortion (see ImagePreprocessing.rectify_images)
+    :param factor: factor to scale images up and down
+    :param size: explicit size of the form (W, H), to which the images should be resized
+    :param workers: Amount of processes
+    :param prefetch: Maximum amount of frames processed ahead, 2 * workers if not given
+    """
+    processor_args = (image_path, model_path, rectify, factor, size)
+
+    if workers <= 1:
+        processor = FrameProcessor(*processor_args)
+        for image_name in image_list:
+            yield processor.process(os.path.join(image_path, image_name))
+        return
+
+    if prefetch is None:
+        prefetch = 2 * workers
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(processor_args, P.enabled)) as executor:
+        try:
+            for image_name in image_list:
+                if len(pending) >= prefetch:
+                    frame, stats = pending.popleft().result()
+                    P.merge(stats)
+                    yield frame
+                pending.append(executor.submit(process_frame, os.path.join(image_path, image_name)))
+            while pending:
+                frame, stats = pending.popleft().result()
+                P.merge(stats)
+                yield frame
+        finally:
+            for future in pending:
+                future.cancel()
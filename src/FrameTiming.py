@@ -0,0 +1,157 @@
+# Imports
+import os
+import numpy as np
+from src import Profiler as P
+
+
+def nominal_frame_rate(timestamps):
+    """
+    :param timestamps: Timestamps of the frames in microseconds
+    :return: Frame rate derived from the median distance of the timestamps
+    """
+    if len(timestamps) < 2:
+        return 25
+    return 1000000 / float(np.median(np.diff(np.asarray(timestamps, dtype=np.int64))))
+
+
+def load_timestamps(path):
+    """
+    Reads a timestamps file of the oxford dataset ('<timestamp> <chunk>' per line).
+    :param path: Path to the timestamps file
+    :return: numpy array of the timestamps in microseconds
+    """
+    return np.loadtxt(path, delimiter=' ', usecols=[0], dtype=np.int64, ndmin=1)
+
+
+def frame_timestamps(image_list, timestamps_path=None):
+    """
+    Determines the capture time of the frames of a camera directory. The timestamps file lists the frames of the
+    camera, frames which are missing in the directory are skipped. Without a timestamps file the timestamps are
+    taken from the names of the frames ('<timestamp>.png').
+    :param image_list: Names of the frames in the directory
+    :param timestamps_path: Path to the timestamps file of the camera, e.g. stereo.timestamps for stereo/centre
+    :return: Tuple (names of the frames, numpy array of their timestamps in microseconds), sorted by timestamp
+    """
+    stems = {}
+    for image_name in image_list:
+        stems[os.path.splitext(image_name)[0]] = image_name
+
+    if timestamps_path:
+        timestamps = np.unique(load_timestamps(timestamps_path))
+        present = np.array([str(timestamp) in stems for timestamp in timestamps.tolist()], dtype=bool)
+        timestamps = timestamps[present]
+        if len(timestamps) == 0:
+            raise Exception("None of the frames is listed in {}.".format(timestamps_path))
+        return [stems[str(timestamp)] for timestamp in timestamps.tolist()], timestamps
+
+    unnamed = [image_name for stem, image_name in stems.items() if not stem.isdigit()]
+    if unnamed:
+        raise Exception("No timestamp for {} frames, e.g. {}.".format(len(unnamed), unnamed[0]))
+    names = sorted(image_list, key=lambda image_name: int(os.path.splitext(image_name)[0]))
+    return names, np.array([int(os.path.splitext(image_name)[0]) for image_name in names], dtype=np.int64)
+
+
+def frame_durations(timestamps):
+    """
+    :param timestamps: Timestamps of the frames in microseconds
+    :return: numpy array of the display duration of every frame in seconds. The last frame is shown for the
+             nominal frame interval.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    durations = np.empty(len(timestamps), dtype=np.float64)
+    durations[:-1] = np.diff(timestamps) / 1000000
+    durations[-1] = 1 / nominal_frame_rate(timestamps)
+    return durations
+
+
+def resample_times(timestamps, frame_rate):
+    """
+    Maps the frames of a constant frame rate video to the recorded frames. Output frame k shows the sequence at
+    timestamps[0] + k / frame_rate and is blended from the two recorded frames around this time.
+    :param timestamps: Sorted timestamps of the recorded frames in microseconds
+    :param frame_rate: Frame rate of the video
+    :return: Tuple of numpy arrays (index of the earlier frame, index of the later frame, weight of the later frame)
+             with one entry per output frame
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    count = int((timestamps[-1] - timestamps[0]) * frame_rate // 1000000) + 1
+    times = timestamps[0] + np.arange(count, dtype=np.float64) * (1000000 / frame_rate)
+
+    lower = np.searchsorted(timestamps, times, side='right') - 1
+    upper = np.minimum(lower + 1, len(timestamps) - 1)
+    span = (timestamps[upper] - timestamps[lower]).astype(np.float64)
+    weights = np.divide(times - timestamps[lower], span, out=np.zeros(count), where=span > 0)
+    return lower, upper, np.clip(weights, 0, 1)
+
+
+def blend_frames(first, second, weights):
+    """
+    Blends pairs of frames in one vectorized operation. The blending is done in 8 bit fixed point arithmetic
+    on uint16, which is exact for the weights 0 and 1 and needs a quarter of the memory of float64.
+    :param first: numpy array of shape (N, H, W) or (N, H, W, C) with the earlier frames (uint8)
+    :param second: numpy array of the same shape with the later frames (uint8)
+    :param weights: N weights of the later frames, between 0 and 1
+    :return: numpy array of the blended frames (uint8)
+    """
+    weights = np.rint(np.asarray(weights, dtype=np.float64) * 256).astype(np.uint16)
+    weights = weights.reshape((-1,) + (1,) * (first.ndim - 1))
+
+    blended = first.astype(np.uint16)
+    blended *= 256 - weights
+    later = np.empty(second.shape, dtype=np.uint16)
+    np.multiply(second, weights, out=later)
+    blended += later
+    blended += 128
+    blended >>= 8
+    return blended.astype(np.uint8)
+
+
+def resample_frames(frames, timestamps, frame_rate, window=8, batch=4):
+    """
+    Resamples a sequence of frames with irregular timestamps to a constant frame rate, so the video keeps the timing
+    of the recording. Frames in between are synthesised by blending the recorded frames around them. The recorded
+    frames are decoded once and kept in a sliding window of window + 1 frames, the output frames of a window are
+    blended in batches of up to 'batch' frames.
+    :param frames: Iterable of the recorded frames as numpy arrays, in timestamp order
+    :param timestamps: Timestamps of the frames in microseconds
+    :param frame_rate: Frame rate of the output
+    :param window: Amount of frame intervals held in memory
+    :param batch: Maximum amount of frames blended at once
+    :return: Generator of the output frames
+    """
+    lower, upper, weights = resample_times(timestamps, frame_rate)
+    count = len(weights)
+    position = 0    # Next output frame
+    base = 0        # Index of the recorded frame in buffer[0]
+    filled = 0
+    buffer = None
+
+    def flush(end):
+        # Emits the output frames whose recorded frames are both in the buffer
+        nonlocal position
+        stop = int(np.searchsorted(upper, end, side='left'))
+        while position < stop:
+            chunk = slice(position, min(position + batch, stop))
+            with P.measure('interpolate', items=chunk.stop - chunk.start) as m:
+                blended = blend_frames(buffer[lower[chunk] - base], buffer[upper[chunk] - base], weights[chunk])
+                m.nbytes = blended.nbytes
+            yield from blended
+            position = chunk.stop
+
+    for frame in frames:
+        if buffer is None:
+            buffer = np.empty((window + 1,) + frame.shape, dtype=np.uint8)
+        buffer[filled] = frame
+        filled += 1
+        if filled == len(buffer):
+            yield from flush(base + filled)
+            # The last frame of the window is the first one of the next window
+            buffer[0] = buffer[filled - 1]
+            base += filled - 1
+            filled = 1
+
+    if buffer is not None:
+        # All remaining output frames lie before the last recorded frame
+        yield from flush(base + filled)
+        if position < count:
+            raise Exception("Got {} frames, but {} timestamps.".format(base + filled, len(timestamps)))
@@ -1,4 +1,25 @@
 import os
+import socket
+import struct
+import subprocess
+import threading
+import time
+from fractions import Fraction
+import numpy as np
+from src import FramePipeline as FP
+from src import FrameTiming as FT
+from src import Profiler as P
+from src.VideoConverter import VideoWriter, sorted_by_timestamp, pix_fmt_of
+
+# Caps of the RTP stream sent by LiveStreamer and start_gstreamer_server
+rtp_caps = "application/x-rtp, media=(string)video, clock-rate=(int)90000, encoding-name=(string)H264, payload=(int)96"
+
+# Fixed part of the RTP header (version/flags, marker/payload type, sequence number, timestamp, ssrc)
+rtp_header = struct.Struct('!BBHII')
+rtp_clock_rate = 90000
+
+# Formats of rawvideoparse for the pixel formats of the frames
+raw_formats = {'gray': 'gray8', 'rgb24': 'rgb', 'rgba': 'rgba'}
 
 
 def start_gstreamer_server(video_path, dst_address, dst_port=9001):
@@ -8,8 +29,284 @@ def start_gstreamer_server(video_path, dst_address, dst_port=9001):
     :param dst_address: provides the ipv4 address to which the video stream is addressed
     :param dst_port: destination port is set to 9001 if not defined differently
     """
-    os.system("gst-launch-1.0 -v filesrc location = " + video_path + "! decodebin ! x264enc ! rtph264pay ! udpsink "
-                                                                     "host=" + dst_address + " port=9001")
+    subprocess.run(['gst-launch-1.0', '-v', 'filesrc', 'location=' + video_path, '!', 'decodebin', '!',
+                    'x264enc', 'tune=zerolatency', '!', 'rtph264pay', 'config-interval=1', 'pt=96', '!',
+                    'udpsink', 'host=' + dst_address, 'port={}'.format(dst_port)], check=True)
+
+
+def start_gstreamer_client(port=9001):
+    subprocess.run(['gst-launch-1.0', '-v', 'udpsrc', 'port={}'.format(port), 'caps=' + rtp_caps, '!',
+                    'rtph264depay', '!', 'decodebin', '!', 'videoconvert', '!', 'autovideosink'], check=True)
+
+
+def parse_destinations(destinations, default_port=9001):
+    """
+    :param destinations: Comma separated destinations of the form host or host:port
+    :return: List of tuples (host, port)
+    """
+    result = []
+    for destination in destinations.split(','):
+        host, _, port = destination.strip().partition(':')
+        result.append((host, int(port) if port else default_port))
+    return result
+
+
+class LiveStreamer(VideoWriter):
+    """
+    Encodes raw frames written to the stdin pipe of a gst-launch subprocess with zero-latency H.264 settings and
+    sends the RTP stream to several destinations. The frames are encoded once and multiudpsink fans the packets out,
+    so the cost of encoding does not grow with the amount of receivers.
+    """
+
+    def __init__(self, destinations, width, height, pix_fmt='rgb24', frame_rate=16, bitrate=4000, key_int=None,
+                 speed_preset='ultrafast'):
+        """
+        :param destinations: List of tuples (host, port) to which the stream is sent
+        :param width: Width of the frames
+        :param height: Height of the frames
+        :param pix_fmt: Pixel format of the frames written (gray, rgb24 or rgba)
+        :param frame_rate: Nominal frame rate of the stream
+        :param bitrate: Bitrate of the encoder in kbit/s
+        :param key_int: Maximum distance of key frames, a key frame every second if not given. Receivers which join
+                        the stream late can decode it from the next key frame on.
+        :param speed_preset: Preset of x264enc, ultrafast keeps the encoding time of a frame lowest
+        """
+        clients = ','.join('{}:{}'.format(host, port) for host, port in destinations)
+        rate = self.rate = Fraction(frame_rate).limit_denominator(1001)
+        if key_int is None:
+            key_int = max(1, int(round(frame_rate)))
+
+        # tune=zerolatency disables the lookahead and B-frames, so every frame leaves the encoder as soon as it
+        # has been encoded. sync=false sends the packets at once instead of waiting for their timestamps.
+        # rawvideoparse timestamps the n-th frame with n / frame_rate and timestamp-offset=0 keeps this time in the
+        # RTP timestamps, so a receiver can tell which frame a packet belongs to (see frame_index).
+        command = ['gst-launch-1.0', '-q',
+                   'fdsrc', 'fd=0', '!',
+                   'rawvideoparse', 'width={}'.format(width), 'height={}'.format(height),
+                   'format=' + raw_formats[pix_fmt], 'framerate={}/{}'.format(rate.numerator, rate.denominator), '!',
+                   'videoconvert', '!', 'video/x-raw,format=I420', '!',
+                   'x264enc', 'tune=zerolatency', 'speed-preset=' + speed_preset, 'bitrate={}'.format(bitrate),
+                   'key-int-max={}'.format(key_int), '!',
+                   'rtph264pay', 'config-interval=1', 'pt=96', 'timestamp-offset=0', '!',
+                   'multiudpsink', 'clients=' + clients, 'sync=false', 'async=false']
+        self.start(command, clients, width, height, pix_fmt)
+
+    def error(self):
+        return Exception("gst-launch failed to stream to {} (exit code {}): {}".format(
+            self.output, self.process.returncode, ''.join(self.stderr[-10:]).strip()))
+
+
+class RtpProbe:
+    """
+    Receiver of the RTP stream on the local host, which records the arrival time of every frame (the packet with the
+    marker bit set is the last one of a frame) together with its RTP timestamp, from which the frame is identified
+    (see frame_index). Lost packets therefore do not shift the arrivals of the following frames.
+    """
+
+    def __init__(self, port, address='127.0.0.1'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        self.sock.bind((address, port))
+        self.sock.settimeout(0.1)
+        self.arrivals = []
+        self.running = True
+        self.thread = threading.Thread(target=self.receive, daemon=True)
+        self.thread.start()
+
+    def receive(self):
+        while self.running:
+            try:
+                packet = self.sock.recv(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(packet) >= 12 and packet[1] & 0x80:
+                self.arrivals.append((rtp_header.unpack_from(packet)[3], time.perf_counter()))
+
+    def stop(self, frames, timeout=1.0):
+        """
+        Waits until the given amount of frames arrived or no frame arrived for 'timeout' seconds and stops.
+        :return: List of tuples (RTP timestamp, arrival time (perf_counter)) of the received frames
+        """
+        received = -1
+        while len(self.arrivals) < frames and len(self.arrivals) != received:
+            received = len(self.arrivals)
+            time.sleep(timeout)
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+        return self.arrivals
+
+
+def frame_index(rtp_timestamp, rate, wraps=0):
+    """
+    :param rtp_timestamp: RTP timestamp of a frame sent by LiveStreamer (90 kHz clock, offset 0)
+    :param rate: Frame rate of the LiveStreamer as Fraction
+    :param wraps: Amount of times the 32 bit RTP timestamp wrapped around before
+    :return: Index of the frame among the frames written to the LiveStreamer
+    """
+    ticks = rtp_timestamp + (wraps << 32)
+    return int(round(Fraction(ticks * rate.numerator, rtp_clock_rate * rate.denominator)))
+
+
+def match_arrivals(arrivals, rate, due_times):
+    """
+    Assigns the frames received by an RtpProbe to the written frames by their RTP timestamps.
+    :param arrivals: List of tuples (RTP timestamp, arrival time) as returned by RtpProbe.stop
+    :param rate: Frame rate of the LiveStreamer as Fraction
+    :param due_times: Time at which every written frame was due
+    :return: List of the latencies (arrival - due time) of the matched frames in seconds. Frames which did not
+             arrive have no latency and count as lost.
+    """
+    latencies = {}
+    wraps = 0
+    previous = None
+    for rtp_timestamp, arrival in arrivals:
+        # The timestamps grow with the frames, a large step back is a wrap-around of the 32 bit counter
+        if previous is not None and rtp_timestamp < previous and previous - rtp_timestamp > 1 << 31:
+            wraps += 1
+        previous = rtp_timestamp
+        index = frame_index(rtp_timestamp, rate, wraps)
+        if 0 <= index < len(due_times) and index not in latencies:
+            latencies[index] = arrival - due_times[index]
+    return [latencies[index] for index in sorted(latencies)]
+
+
+def stream_statistics(frames, sent, dropped, lags, latencies, duration):
+    """
+    :param frames: Amount of frames of the sequence
+    :param sent: Amount of frames written to the encoder
+    :param dropped: Amount of frames dropped since they were late
+    :param lags: Time between the scheduled and the actual writing of every sent frame in seconds
+    :param latencies: Time between the scheduled writing and the arrival of every received frame in seconds, or
+                      None if the stream was not probed
+    :param duration: Duration of the stream in seconds
+    :return: Dictionary with the amounts of frames, frame rate, lag and end-to-end latency in milliseconds
+    """
+    lags = np.asarray(lags, dtype=np.float64) * 1000 if len(lags) else np.zeros(1)
+    stats = {'frames': frames, 'sent': sent, 'dropped': dropped,
+             'duration_s': duration,
+             'frames_per_s': sent / duration if duration > 0 else 0.0,
+             'lag_mean_ms': float(lags.mean()),
+             'lag_p99_ms': float(np.percentile(lags, 99)),
+             'lag_max_ms': float(lags.max())}
+    if latencies is not None:
+        received = len(latencies)
+        latencies = np.asarray(latencies, dtype=np.float64) * 1000 if received else np.zeros(1)
+        stats.update({'received': received, 'lost': sent - received,
+                      'latency_mean_ms': float(latencies.mean()),
+                      'latency_p50_ms': float(np.percentile(latencies, 50)),
+                      'latency_p99_ms': float(np.percentile(latencies, 99)),
+                      'latency_max_ms': float(latencies.max())})
+    return stats
+
+
+def format_statistics(stats):
+    """
+    :param stats: Dictionary as returned by stream_statistics
+    :return: Human readable summary of the statistics
+    """
+    text = ('Streamed {sent} of {frames} frames ({dropped} dropped late) in {duration_s:.2f} s ({frames_per_s:.1f} '
+            'fps), lag mean {lag_mean_ms:.3f} ms, p99 {lag_p99_ms:.3f} ms.'.format(**stats))
+    if 'received' in stats:
+        text += ('\nReceived {received} frames ({lost} lost), end-to-end latency mean {latency_mean_ms:.1f} ms, '
+                 'p99 {latency_p99_ms:.1f} ms, max {latency_max_ms:.1f} ms.'.format(**stats))
+    return text
 
-def start_gstreamer_client():
-    os.system("gst-launch-1.0 -v udpsrc port=9001 caps = \"application/x-rtp, media=(string)video, clock-rate=(int)90000, encoding-name=(string)H264, payload=(int)96\" ! rtph264depay ! decodebin ! videoconvert ! autovideosink")
\ No newline at end of file
+
+def stream_frames(frames, timestamps, destinations, speed=1.0, max_lag=None, bitrate=4000, probe_port=None):
+    """
+    Streams the frames paced by their timestamps, like a live camera. A frame which is more than max_lag seconds
+    late (e.g. since decoding could not keep up) is dropped instead of being queued, so the stream stays real-time.
+    :param frames: Iterable of frames as numpy arrays
+    :param timestamps: Timestamps of the frames in microseconds
+    :param destinations: List of tuples (host, port) to which the stream is sent
+    :param speed: Speed multiplier, 2.0 streams twice as fast as recorded
+    :param max_lag: Maximum lag of a frame in seconds, one frame interval if not given
+    :param bitrate: Bitrate of the encoder in kbit/s
+    :param probe_port: If given, the stream is also sent to this port on the local host, where the arrival of the
+                       frames is recorded to measure the end-to-end latency and lost frames
+    :return: Dictionary with the statistics, see stream_statistics
+    """
+    if speed <= 0:
+        raise Exception("The stream speed has to be greater than 0.")
+    frame_rate = FT.nominal_frame_rate(timestamps) * speed
+    if max_lag is None:
+        max_lag = 1 / frame_rate
+
+    probe = None
+    if probe_port is not None:
+        probe = RtpProbe(probe_port)
+        destinations = list(destinations) + [('127.0.0.1', probe_port)]
+
+    streamer = None
+    start_time = None
+    dropped = 0
+    due_times, lags = [], []
+    try:
+        for timestamp, frame in zip(timestamps, frames):
+            if streamer is None:
+                streamer = LiveStreamer(destinations, frame.shape[1], frame.shape[0], pix_fmt_of(frame), frame_rate,
+                                        bitrate)
+                start_time = time.perf_counter()
+            due = start_time + (timestamp - timestamps[0]) / 1000000 / speed
+
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lag = time.perf_counter() - due
+            if lag > max_lag:
+                dropped += 1
+                continue
+
+            streamer.write(frame)
+            due_times.append(due)
+            lags.append(lag)
+    except BaseException:
+        if streamer is not None:
+            streamer.abort()
+        if probe is not None:
+            probe.stop(0, 0)
+        raise
+
+    duration = time.perf_counter() - start_time if start_time else 0.0
+    if streamer is not None:
+        streamer.close()
+
+    latencies = None
+    if probe is not None:
+        arrivals = probe.stop(len(due_times))
+        latencies = match_arrivals(arrivals, streamer.rate, due_times) if streamer is not None else []
+        for latency in latencies:
+            P.record('stream latency', latency)
+    return stream_statistics(len(timestamps), len(due_times), dropped, lags, latencies, duration)
+
+
+def stream_images(image_path, destinations, model_path=None, rectify=False, factor=None, size=None, speed=1.0,
+                  max_lag=None, bitrate=4000, probe_port=None, workers=1):
+    """
+    Streams the images of a directory, which are named by their timestamps (<timestamp>.png) as in the oxford
+    dataset. The frames are rectified and resized in memory (see FramePipeline.process_frames) and processed ahead
+    by 'workers' processes, so the pacing is not held up by decoding.
+    :param image_path: Path to the directory where the images reside
+    :param destinations: List of tuples (host, port) to which the stream is sent
+    :param model_path: Path to the camera models that are contained in the robotcar_dataset_sdk
+    :param rectify: Perform Bayer demosaicing and undistortion
+    :param factor: factor to scale images up and down
+    :param size: explicit size of the form (W, H), to which the images should be resized
+    :param speed: Speed multiplier, 2.0 streams twice as fast as recorded
+    :param max_lag: Maximum lag of a frame in seconds, one frame interval if not given
+    :param bitrate: Bitrate of the encoder in kbit/s
+    :param probe_port: Local port on which the end-to-end latency is measured (see stream_frames)
+    :param workers: Amount of processes used to process the frames
+    :return: Dictionary with the statistics, see stream_statistics
+    """
+    image_list = [name for name in sorted_by_timestamp(FP.list_images(image_path))
+                  if os.path.splitext(name)[0].isdigit()]
+    timestamps = [int(os.path.splitext(name)[0]) for name in image_list]
+    frames = FP.process_frames(image_path, image_list, model_path, rectify, factor, size, workers)
+    try:
+        return stream_frames(frames, timestamps, destinations, speed, max_lag, bitrate, probe_port)
+    finally:
+        frames.close()
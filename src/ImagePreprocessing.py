@@ -1,13 +1,16 @@
 # Imports
 import os
-import subprocess
 from PIL import Image
 import time
 # from ISR.models import RDN, \
 #     RRDN  # install tensorflow 1.13.1 with the command "pip install https://storage.googleapis.com/tensorflow/mac/cpu/tensorflow-1.13.1-py3-none-any.whl"
 import numpy as np
+import cv2
 from robotcar_dataset_sdk.python import image
 from robotcar_dataset_sdk.python.camera_model import CameraModel
+from src.UpscaleClient import UpscaleClient, default_endpoint
+from src import FrameTiming as FT
+from src import Profiler as P
 
 
 def rectify_images(image_path, model_path=None):
@@ -28,15 +31,121 @@ def rectify_images(image_path, model_path=None):
     image_list = [x for x in os.listdir(image_path) if not x.startswith('.')]
 
     for i, image_name in enumerate(image_list):
-        im = image.load_image(image_path + image_name, model=model)
+        im = rectify_frame(image_path + image_name, model, model_path)
         Image.fromarray(im).save(image_path + image_name)
 
 
-def interpolate_images(image_path1, image_path2):
+def rectify_frame(image_file, model=None, model_path=None):
+    """
+    Performs Bayer demosaicing and, if a model is given, undistortion of a single image.
+    The undistortion is done with precomputed remap tables (see load_undistortion_maps).
+    :param image_file: Path to the image
+    :param model: Camera model of the robotcar_dataset_sdk
+    :param model_path: Path to the camera models, where the remap tables are cached
+    :return: Rectified image as numpy array
+    """
+    with P.measure('png decode') as m:
+        im = image.load_image(image_file)
+        m.nbytes = im.nbytes
+    if model is None:
+        return im
+    with P.measure('rectify', nbytes=im.nbytes):
+        map1, map2 = load_undistortion_maps(model, im.shape[1], im.shape[0], model_path)
+        return cv2.remap(im, map1, map2, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                         borderValue=0)
+
+
+# Remap tables already loaded by this process, keyed by (model path, model name, width, height, fixed point)
+undistortion_maps = {}
+
+# Models of the sensors of the stereo camera, as chosen by the CameraModel of the robotcar_dataset_sdk
+stereo_models = {'left': 'stereo_wide_left', 'right': 'stereo_wide_right', 'centre': 'stereo_narrow_left'}
+
+
+def model_name(model):
+    """
+    Name of the files of a camera model (<name>.txt and <name>_distortion_lut.bin). CameraModel only stores the
+    camera ('stereo' for all three stereo sensors) and the sensor, the name is derived from them like the SDK does.
+    :param model: Camera model of the robotcar_dataset_sdk
+    :return: Name of the model, e.g. stereo_narrow_left for stereo/centre or mono_left
+    """
+    if model.camera == 'stereo':
+        return stereo_models[model.camera_sensor]
+    return model.camera
+
+
+def load_undistortion_maps(model, width, height, model_path=None, fixed_point=True):
+    """
+    Returns the remap tables for cv2.remap, which undistort an image of the given size like model.undistort does.
+    The tables are built once from the bilinear lookup table of the model and stored next to the model files
+    (as <model>_<width>x<height>_fixed_remap.npz, or <model>_<width>x<height>_remap.npz without fixed_point, with
+    the name of the model as returned by model_name), so they can be reused by later runs. They are rebuilt if the
+    distortion lookup table of the model is newer than the stored tables.
+    :param model: Camera model of the robotcar_dataset_sdk
+    :param width: Width of the images
+    :param height: Height of the images
+    :param model_path: Path to the camera models, the tables are only kept in memory if not given
+    :param fixed_point: Convert the tables to the fixed-point representation, which is remapped faster
+    :return: map1, map2 as expected by cv2.remap
+    """
+    name = model_name(model)
+    key = (model_path, name, width, height, fixed_point)
+    if key in undistortion_maps:
+        return undistortion_maps[key]
+
+    cache_file = None
+    if model_path:
+        cache_file = os.path.join(model_path, "{}_{}x{}_{}remap.npz".format(
+            name, width, height, "fixed_" if fixed_point else ""))
+        lut_file = os.path.join(model_path, name + "_distortion_lut.bin")
+        if os.path.isfile(cache_file) and (not os.path.isfile(lut_file)
+                                           or os.path.getmtime(lut_file) <= os.path.getmtime(cache_file)):
+            with np.load(cache_file) as tables:
+                undistortion_maps[key] = (tables["map1"], tables["map2"])
+            return undistortion_maps[key]
+
+    if width * height != model.bilinear_lut.shape[0]:
+        raise ValueError("Incorrect image size for camera model")
+    # The lookup table contains the (x, y) position in the distorted image for every pixel
+    map1 = model.bilinear_lut[:, 0].reshape(height, width).astype(np.float32)
+    map2 = model.bilinear_lut[:, 1].reshape(height, width).astype(np.float32)
+    # Pixels mapped outside of the image are black, without blending with the border pixels (as map_coordinates)
+    outside = (map1 < 0) | (map1 > width - 1) | (map2 < 0) | (map2 > height - 1)
+    map1[outside] = -2
+    map2[outside] = -2
+    if fixed_point:
+        map1, map2 = cv2.convertMaps(map1, map2, cv2.CV_16SC2)
+
+    if cache_file:
+        try:
+            tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+            with open(tmp_file, "wb") as f:
+                np.savez(f, map1=map1, map2=map2)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass    # The models directory may be read-only, the tables are kept in memory anyway
+
+    undistortion_maps[key] = (map1, map2)
+    return map1, map2
+
+
+def interpolate_images(image_path1, image_path2, output_path, alpha=0.5):
+    """
+    Synthesises an image between two images by blending them, see FrameTiming.blend_frames. Whole sequences are
+    resampled with FrameTiming.resample_frames.
+    :param image_path1: path to the first image
+    :param image_path2: path to the second image, it is converted to the mode of the first one
+    :param output_path: path of the blended image (png)
+    :param alpha: weight of the second image, 0 gives the first and 1 the second image
+    """
     with Image.open(image_path1) as im1:
         with Image.open(image_path2) as im2:
-            res = Image.blend(im1, im2, alpha=0.5)
-            res.save("test", format="png")
+            first = np.array(im1)
+            second = np.array(im2.convert(im1.mode) if im2.mode != im1.mode else im2)
+    if first.shape != second.shape:
+        raise Exception("Images of shape {} and {} cannot be blended.".format(first.shape, second.shape))
+    blended = FT.blend_frames(first[None], second[None], [alpha])[0]
+    Image.fromarray(blended).save(output_path, format="png")
 
 
 def resize_image(image_path, factor=None, size=None):
@@ -58,33 +167,46 @@ def resize_image(image_path, factor=None, size=None):
     # Create a list of the files of the directory
     image_list = [x for x in os.listdir(image_path) if not x.startswith('.')]
 
+    for image_name in image_list:
+        with Image.open(image_path + image_name) as im:
+            res = resize_frame(im, factor=factor, size=size)
+            res.save(image_path + image_name, format="png")
+
+
+def resize_frame(im, factor=None, size=None):
+    """
+    Resizes a single image either by a factor, or to an explicit size.
+    :param im: PIL image
+    :param factor: factor to scale the image up and down
+    :param size: explicit size of the form (W, H), to which the image should be resized
+    :return: Resized PIL image
+    """
     if factor:
-        for image_name in image_list:
-            with Image.open(image_path + image_name) as im:
-                res = im.resize((int(float(im.size[0]) * factor), int(float(im.size[1]) * factor)),
-                                resample=Image.BICUBIC)
-                res.save(image_path + image_name, format="png")
-    elif size:
-        for image_name in image_list:
-            with Image.open(image_path + image_name) as im:
-                res = im.resize(size)
-                res.save(image_path + image_name, format="png")
+        return im.resize((int(float(im.size[0]) * factor), int(float(im.size[1]) * factor)),
+                         resample=Image.BICUBIC)
+    return im.resize(size)
 
 
-def upscale_image(image_path):
+def upscale_image(image_path, endpoints=(default_endpoint,), concurrency=4, retries=3, timeout=120):
     """
     This methode scales the given images up with help of the max-image-resolution-enhancer available on github
     (https://github.com/IBM/MAX-Image-Resolution-Enhancer#3-use-the-model).
     It takes the path to the directory, where the images reside, as an argument and scales each of them up as
-    much as possible. The original images are replaced by the upscaled ones in the same directory.
+    much as possible. The original images are replaced by the upscaled ones in the same directory, an image is only
+    replaced if it was upscaled successfully.
     Make sure that the docker daemon is running for this method (systemctl start docker)!
 
     :param image_path: Path to the directory where the images reside.
+    :param endpoints: URLs of the predict route of one or more running services
+    :param concurrency: Amount of requests in flight at the same time
+    :param retries: Amount of retries of a failed request
+    :param timeout: Timeout of a request in seconds
     """
 
     # Perform image upscaling
     image_list = [x for x in os.listdir(image_path) if not x.startswith('.')]
-    for image_name in image_list:
-        subprocess.call("curl -X POST \"http://localhost:5000/model/predict\" -H  \"accept: application/json\" -H  "
-                        "\"Content-Type: multipart/form-data\" -F \"image=@{};type=image/png\" --output {}".format(
-            image_path + image_name, image_path + image_name), shell=True)
+    client = UpscaleClient(endpoints, concurrency=concurrency, retries=retries, timeout=timeout)
+    failed = client.upscale_files((image_path + image_name, image_path + image_name) for image_name in image_list)
+    if failed:
+        raise Exception("Upscaling of {} of {} images failed, e.g. {}: {}".format(
+            len(failed), len(image_list), failed[0][0], failed[0][1]))
@@ -8,6 +8,15 @@ from scapy.layers.inet import Ether, IP, UDP
 flag = b'\xff\xee'
 factory_byte = b'\37\21'
 
+# Layout of one HDL-32E data packet (1206 bytes). Values are written big-endian, since this is how the
+# byte-wise encoder based on dec_to_hexbyte has always serialized them.
+velodyne_block_dtype = np.dtype([('flag', 'V2'),
+                                 ('azimuth', '>u2'),
+                                 ('channels', [('range', '>u2'), ('intensity', 'u1')], (32,))])
+velodyne_payload_dtype = np.dtype([('blocks', velodyne_block_dtype, (12,)),
+                                   ('timestamp', '>u4'),
+                                   ('factory', 'V2')])
+
 
 def load_velodyne_raw(velodyne_raw_path):
     """Decode a raw Velodyne example. (of the form '<timestamp>.png')
@@ -49,18 +58,70 @@ def create_velodyne_payload(ranges, intensities, angles, timestamp):
     :param timestamp: Real timestamps of each mesaurement (1 x N).
     :return: Payload for one velodyne hdl-32e packet.
     '''
-    payload = b''
-
-    for i in range(12):
-        payload += flag  # Add flag
-        payload += dec_to_hexbyte(angles[0, i], num_bytes=2)
-        for j in range(32):
-            payload += dec_to_hexbyte(ranges[j, i], num_bytes=2)
-            payload += dec_to_hexbyte(intensities[j, i])
-
-    payload += dec_to_hexbyte(convert_timestamp(timestamp[0]), num_bytes=4)
-    payload += factory_byte
-    return payload
+    timestamps = np.asarray(timestamp).reshape(1, -1)[:, :1]
+    return bytes(create_velodyne_payloads(ranges, intensities, angles, timestamps)[0])
+
+
+def create_velodyne_payloads(ranges, intensities, angles, timestamps):
+    '''
+    This function creates the payloads of all packets of one scan at once. The data is written into one
+    preallocated buffer of dtype velodyne_payload_dtype, the output is byte-identical to calling
+    create_velodyne_payload for every packet.
+    :param ranges: Range of each measurement in meters where 0 == invalid, (32 x N)
+    :param intensities: Intensity of each measurement where 0 == invalid, (32 x N)
+    :param angles: Angle of each measurement (azimuth) (1 x N)
+    :param timestamps: Real timestamps of each packet (1 x N/12), as returned by load_velodyne_raw.
+    :return: List of memoryviews (one per packet) on the payload buffer.
+    '''
+    buffer = encode_velodyne_payloads(ranges, intensities, angles, timestamps)
+    return split_payloads(memoryview(buffer.view(np.uint8)))
+
+
+def encode_velodyne_payloads(ranges, intensities, angles, timestamps, out=None):
+    '''
+    Encodes the payloads of all packets of one scan into a buffer of dtype velodyne_payload_dtype.
+    :param ranges: Range of each measurement in meters where 0 == invalid, (32 x N)
+    :param intensities: Intensity of each measurement where 0 == invalid, (32 x N)
+    :param angles: Angle of each measurement (azimuth) (1 x N)
+    :param timestamps: Real timestamps of each packet (1 x N/12), as returned by load_velodyne_raw.
+    :param out: Optional buffer (e.g. shared memory) of at least velodyne_payload_size(timestamps) bytes,
+                into which the payloads are written.
+    :return: Structured array with one element per packet.
+    '''
+    num_packets = timestamps.shape[1]
+    num_blocks = num_packets * 12
+    if ranges.shape[1] < num_blocks:
+        raise RuntimeError("Scan contains {} measurements, but {} are needed for {} packets.".format(
+            ranges.shape[1], num_blocks, num_packets))
+
+    buffer = np.ndarray(num_packets, dtype=velodyne_payload_dtype, buffer=out)
+    blocks = buffer['blocks']   # (packets x 12), can not be flattened without a copy
+    blocks['flag'] = np.void(flag)
+    blocks['azimuth'] = angles[0, :num_blocks].reshape(num_packets, 12)
+    blocks['channels']['range'] = ranges[:, :num_blocks].T.reshape(num_packets, 12, 32)
+    blocks['channels']['intensity'] = intensities[:, :num_blocks].T.reshape(num_packets, 12, 32)
+    buffer['timestamp'] = convert_timestamp(timestamps[0, :num_packets])
+    buffer['factory'] = np.void(factory_byte)
+    return buffer
+
+
+def velodyne_payload_size(timestamps):
+    '''
+    :param timestamps: Real timestamps of each packet (1 x N/12), as returned by load_velodyne_raw.
+    :return: Size in bytes of all payloads of the scan.
+    '''
+    return timestamps.shape[1] * velodyne_payload_dtype.itemsize
+
+
+def split_payloads(buffer):
+    '''
+    Splits a buffer of encoded payloads into one memoryview per packet without copying the data.
+    :param buffer: Bytes-like object containing the payloads
+    :return: List of memoryviews (one per packet)
+    '''
+    raw = memoryview(buffer).cast('B')
+    size = velodyne_payload_dtype.itemsize
+    return [raw[i * size:(i + 1) * size] for i in range(len(raw) // size)]
 
 
 def dec_to_hexbyte(dec, num_bytes=1):
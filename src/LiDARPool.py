@@ -0,0 +1,125 @@
+# Imports
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from src import LiDAR as LI
+from src import ScanCache as SC
+from src import Profiler as P
+
+
+def load_scan(filename, cache_dir=None):
+    '''
+    Loads one raw Velodyne scan, from the decoded-scan cache if cache_dir is given.
+    '''
+    with P.measure('png decode') as m:
+        if cache_dir:
+            scan = SC.load_velodyne_cached(filename, cache_dir)
+        else:
+            scan = LI.load_velodyne_raw(filename)
+        m.nbytes = sum(array.nbytes for array in scan)
+    return scan
+
+
+def encode_payloads(ranges, intensities, angles, timestamps, out=None):
+    with P.measure('payload encode', items=timestamps.shape[1], nbytes=LI.velodyne_payload_size(timestamps)):
+        return LI.encode_velodyne_payloads(ranges, intensities, angles, timestamps, out=out)
+
+
+def encode_scan(filename, cache_dir=None):
+    '''
+    Loads one raw Velodyne scan and encodes the payloads of all its packets.
+    :param filename: Path to the raw Velodyne example (of the form '<timestamp>.png')
+    :param cache_dir: Root directory of the decoded-scan cache (see ScanCache), not used if not given
+    :return: Payload buffer (structured array of dtype LiDAR.velodyne_payload_dtype) and
+             the timestamps of the packets (1 x N/12)
+    '''
+    ranges, intensities, angles, timestamps = load_scan(filename, cache_dir)
+    return encode_payloads(ranges, intensities, angles, timestamps), timestamps
+
+
+def encode_scan_to_shared_memory(filename, cache_dir=None):
+    '''
+    Worker function of encode_scans. The payloads are encoded directly into a new shared memory block, so only its
+    name and the timestamps have to be sent back to the main process.
+    :param filename: Path to the raw Velodyne example (of the form '<timestamp>.png')
+    :param cache_dir: Root directory of the decoded-scan cache (see ScanCache), not used if not given
+    :return: Name of the shared memory block, the timestamps of the packets (1 x N/12) and the profiling
+             statistics of the worker (see Profiler.take)
+    '''
+    ranges, intensities, angles, timestamps = load_scan(filename, cache_dir)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, LI.velodyne_payload_size(timestamps)))
+    try:
+        payloads = encode_payloads(ranges, intensities, angles, timestamps, out=shm.buf)
+        del payloads    # Release the export of shm.buf, otherwise it can not be closed
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    # The block is owned (and unlinked) by the main process from now on. Without unregistering it, the resource
+    # tracker of the worker would unlink it when the worker exits.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm.name, timestamps, P.take()
+
+
+def release_shared_memory(name):
+    shm = shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
+
+
+def encode_scans(filenames, workers=1, prefetch=None, cache_dir=None):
+    '''
+    Encodes the payloads of the given scans, optionally in a pool of 'workers' processes. The results are
+    yielded in the order of 'filenames', so the packets can be written exactly as in a serial run.
+    The payloads are memoryviews on a buffer which is only valid until the next result is requested.
+    :param filenames: Iterable of paths to raw Velodyne examples. Scans of several directories can be chained.
+    :param workers: Amount of processes. With 1 (or less) the scans are encoded in the current process.
+    :param prefetch: Maximum amount of scans in flight, 2 * workers if not given
+    :param cache_dir: Root directory of the decoded-scan cache (see ScanCache), not used if not given
+    :return: Generator of tuples (list of payloads, timestamps of the packets (1 x N/12))
+    '''
+    if workers <= 1:
+        for filename in filenames:
+            buffer, timestamps = encode_scan(filename, cache_dir)
+            yield LI.split_payloads(buffer.view('u1')), timestamps
+        return
+
+    if prefetch is None:
+        prefetch = 2 * workers
+
+    filenames = iter(filenames)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=P.init_worker, initargs=(P.enabled,)) as executor:
+        try:
+            for filename in filenames:
+                pending.append(executor.submit(encode_scan_to_shared_memory, filename, cache_dir))
+                if len(pending) >= prefetch:
+                    break
+
+            while pending:
+                name, timestamps, stats = pending.popleft().result()
+                P.merge(stats)
+                for filename in filenames:
+                    pending.append(executor.submit(encode_scan_to_shared_memory, filename, cache_dir))
+                    break
+
+                shm = shared_memory.SharedMemory(name=name)
+                payloads = LI.split_payloads(shm.buf[:LI.velodyne_payload_size(timestamps)])
+                try:
+                    yield payloads, timestamps
+                finally:
+                    for payload in payloads:
+                        payload.release()
+                    del payloads
+                    shm.close()
+                    shm.unlink()
+        finally:
+            # Free the blocks of scans which have been encoded, but not consumed (e.g. after an error)
+            for future in pending:
+                if future.cancel():
+                    continue
+                try:
+                    release_shared_memory(future.result()[0])
+                except Exception:
+                    pass
@@ -0,0 +1,286 @@
+# Imports
+import glob
+import json
+import os
+from array import array
+import numpy as np
+from src import PcapWriter as PW
+
+manifest_version = 2
+
+# Sidecar index of a segment: Unix timestamp (microseconds) of a data packet, as in the timestamps files of the dataset,
+# and the offset of its record
+index_dtype = np.dtype([('unix_us', '<i8'), ('offset', '<i8')])
+
+
+class SegmentedPcapWriter:
+    '''
+    Writes the packets of one sensor to a series of pcap segments instead of one monolithic file. A segment is
+    rotated once it reaches max_bytes or covers max_duration seconds, always at the end of a scan. The segment in
+    progress is written as '.part' file and only renamed when it is complete, together with its sidecar index
+    (<segment>.idx.npy, see index_dtype) and an entry in the manifest (<name>.segments.json). The time of a record
+    is the timestamp of its packet, so the pcap can be replayed with the timing of the recording. After an
+    interruption the writer resumes after the last completed segment, the caller skips the first 'scans' scans.
+    '''
+
+    def __init__(self, directory, name, max_bytes=None, max_duration=None, index_stride=1, **pcap_args):
+        '''
+        :param directory: Directory of the segments, e.g. out/velodyne_left
+        :param name: Name of the sensor, used as prefix of the segments
+        :param max_bytes: Maximum size of a segment in bytes (it is exceeded by at most one scan)
+        :param max_duration: Maximum duration of a segment in seconds of recording time
+        :param index_stride: Every index_stride-th data packet is indexed
+        :param pcap_args: Further arguments of PcapWriter, e.g. the addresses
+        '''
+        self.directory = directory
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration
+        self.index_stride = index_stride
+        self.pcap_args = pcap_args
+        self.manifest_path = os.path.join(directory, name + '.segments.json')
+        os.makedirs(directory, exist_ok=True)
+
+        self.segments = []
+        self.complete = False
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == manifest_version:
+                self.segments = manifest['segments']
+                self.complete = manifest.get('complete', False)
+        # Segments which were in progress when the previous run was interrupted
+        for path in glob.glob(os.path.join(glob.escape(directory), glob.escape(name) + '_*.part')):
+            os.remove(path)
+
+        self.writer = None
+        self.segment = None
+
+    @property
+    def scans(self):
+        '''
+        Amount of scans in the completed segments, which do not have to be written again.
+        '''
+        return sum(segment['scans'] for segment in self.segments)
+
+    @property
+    def packets(self):
+        '''
+        Amount of data packets in the completed segments.
+        '''
+        return sum(segment['packets'] for segment in self.segments)
+
+    def resume(self, scan_files):
+        '''
+        Checks that the completed segments were written from the given scans and discards them otherwise.
+        :param scan_files: Paths to all scans of the sensor
+        :return: Amount of scans to skip
+        '''
+        position = 0
+        for i, segment in enumerate(self.segments):
+            if position >= len(scan_files) or os.path.basename(scan_files[position]) != segment['first_scan'] \
+                    or not os.path.isfile(os.path.join(self.directory, segment['file'])):
+                for stale in self.segments[i:]:
+                    for path in (stale['file'], stale['index']):
+                        if os.path.isfile(os.path.join(self.directory, path)):
+                            os.remove(os.path.join(self.directory, path))
+                self.segments = self.segments[:i]
+                self.save_manifest()
+                break
+            position += segment['scans']
+        return self.scans
+
+    def begin_scan(self, scan_file):
+        '''
+        Has to be called before the packets of each scan are written.
+        :param scan_file: Path to the scan, stored to check the segments when resuming
+        '''
+        if self.writer is None:
+            number = len(self.segments)
+            stem = '{}_{:05d}'.format(self.name, number)
+            self.segment = {'file': stem + '.pcap', 'index': stem + '.idx.npy',
+                            'first_scan': os.path.basename(scan_file), 'scans': 0, 'packets': 0,
+                            'first_unix_us': None, 'last_unix_us': None}
+            self.timestamps = array('q')
+            self.offsets = array('q')
+            self.writer = PW.PcapWriter(os.path.join(self.directory, stem + '.pcap.part'), **self.pcap_args)
+            self.complete = False
+
+    def write(self, payload, timestamp, udp_s=2368, udp_d=2368):
+        '''
+        Writes one data packet.
+        :param payload: Payload of the udp packet
+        :param timestamp: Unix timestamp of the packet in microseconds, as returned by LiDAR.load_velodyne_raw
+        '''
+        segment = self.segment
+        if segment['packets'] % self.index_stride == 0:
+            self.timestamps.append(timestamp)
+            self.offsets.append(self.writer.size)
+        if segment['first_unix_us'] is None:
+            segment['first_unix_us'] = timestamp
+        segment['last_unix_us'] = timestamp
+        segment['packets'] += 1
+        self.writer.write(payload, udp_s, udp_d, timestamp=timestamp / 1000000)
+
+    def write_frame(self, frame, timestamp=None):
+        '''
+        Writes an already assembled frame (e.g. a position packet), which is not indexed.
+        :param timestamp: Unix timestamp of the frame in microseconds, the current time is used if not given
+        '''
+        self.writer.write_frame(frame, timestamp / 1000000 if timestamp is not None else None)
+
+    def build_frame(self, payload, udp_s=2368, udp_d=2368):
+        '''
+        Builds a whole frame to be written with write_frame, see PcapWriter.build_frame.
+        '''
+        template = PW.HeaderTemplate(self.pcap_args.get('eth_s', PW.default_eth_s),
+                                     self.pcap_args.get('eth_d', PW.default_eth_d),
+                                     self.pcap_args.get('ip_s', PW.default_ip_s),
+                                     self.pcap_args.get('ip_d', PW.default_ip_d), udp_s, udp_d)
+        return template.build(payload) + bytes(payload)
+
+    def end_scan(self):
+        '''
+        Has to be called after the packets of each scan are written. Completes the segment if it is full.
+        '''
+        self.segment['scans'] += 1
+        full = self.max_bytes and self.writer.size >= self.max_bytes
+        if self.max_duration and self.segment['first_unix_us'] is not None:
+            full = full or self.segment['last_unix_us'] - self.segment['first_unix_us'] >= \
+                self.max_duration * 1000000
+        if full:
+            self.finish_segment()
+
+    def finish_segment(self):
+        '''
+        Closes the current segment, writes its index and adds it to the manifest. The order (index, segment,
+        manifest) guarantees that a segment listed in the manifest is complete.
+        '''
+        segment = self.segment
+        self.writer.close()
+        segment['bytes'] = self.writer.size
+        index = np.empty(len(self.timestamps), dtype=index_dtype)
+        index['unix_us'] = np.frombuffer(self.timestamps, dtype=np.int64)
+        index['offset'] = np.frombuffer(self.offsets, dtype=np.int64)
+
+        index_path = os.path.join(self.directory, segment['index'])
+        with open(index_path + '.part', 'wb') as f:
+            np.save(f, index)
+        os.replace(index_path + '.part', index_path)
+        os.replace(os.path.join(self.directory, segment['file'] + '.part'),
+                   os.path.join(self.directory, segment['file']))
+
+        self.segments.append(segment)
+        self.save_manifest()
+        self.writer = None
+        self.segment = None
+
+    def save_manifest(self):
+        manifest = {'version': manifest_version, 'name': self.name, 'index_stride': self.index_stride,
+                    'complete': self.complete, 'segments': self.segments}
+        tmp_path = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def close(self):
+        '''
+        Completes the last segment and marks the capture as complete.
+        '''
+        if self.writer is not None:
+            if self.segment['scans']:
+                self.finish_segment()
+            else:
+                self.writer.close()
+                os.remove(os.path.join(self.directory, self.segment['file'] + '.part'))
+                self.writer = None
+        self.complete = True
+        self.save_manifest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            # The incomplete segment stays as '.part' file and is removed when resuming
+            self.writer.close()
+
+
+def load_segments(directory, name):
+    '''
+    :param directory: Directory of the segments
+    :param name: Name of the sensor
+    :return: List of the completed segments as stored in the manifest, with the paths of segment and index and the
+             index stride
+    '''
+    with open(os.path.join(directory, name + '.segments.json')) as f:
+        manifest = json.load(f)
+    return [dict(segment, path=os.path.join(directory, segment['file']),
+                 index_path=os.path.join(directory, segment['index']), index_stride=manifest['index_stride'])
+            for segment in manifest['segments']]
+
+
+def find_offset(index, timestamp, side='left', stride=1):
+    '''
+    Looks up a record by the timestamp of its packet without reading the segment.
+    :param index: Sidecar index of the segment (see index_dtype)
+    :param timestamp: Unix timestamp in microseconds
+    :param side: 'left' for the first data packet with a timestamp >= timestamp, 'right' for the first one > timestamp.
+                 With a stride > 1 'left' returns the last indexed packet before, so no packet is missed.
+    :param stride: Index stride of the segment
+    :return: Offset of the record in the segment, or None if all indexed packets are older
+    '''
+    position = int(np.searchsorted(index['unix_us'], timestamp, side=side))
+    if side == 'left' and stride > 1 and position > 0:
+        position -= 1
+    if position >= len(index):
+        return None
+    return int(index['offset'][position])
+
+
+def read_records(path, offset=None, end_offset=None):
+    '''
+    Reads the records of a pcap segment, starting at the given offset.
+    :param path: Path to the segment
+    :param offset: Offset of the first record, e.g. from find_offset. The first record if not given.
+    :param end_offset: Offset at which reading stops, the end of the file if not given
+    :return: Generator of tuples (record timestamp in seconds, frame)
+    '''
+    with open(path, 'rb') as f:
+        position = offset if offset is not None else len(PW.pcap_global_header)
+        f.seek(position)
+        while end_offset is None or position < end_offset:
+            header = f.read(PW.pcap_record_header.size)
+            if len(header) < PW.pcap_record_header.size:
+                break
+            sec, usec, length, _ = PW.pcap_record_header.unpack(header)
+            yield sec + usec / 1000000, f.read(length)
+            position += PW.pcap_record_header.size + length
+
+
+def read_range(directory, name, start, end=None):
+    '''
+    Reads the frames of a capture between two timestamps (inclusive). Only the segments which overlap the
+    range are opened and reading starts at the offset found in their index, so no linear scan of the capture is
+    needed. Position packets between the data packets are included. With an index stride > 1 up to stride - 1 data
+    packets outside of the range may be returned at both ends.
+    Segments are independent pcap files, so ranges can also be read in parallel, e.g. one segment per process.
+    :param directory: Directory of the segments
+    :param name: Name of the sensor
+    :param start: First Unix timestamp in microseconds
+    :param end: Last Unix timestamp in microseconds, the end of the capture if not given
+    :return: Generator of tuples (record timestamp in seconds, frame)
+    '''
+    for segment in load_segments(directory, name):
+        if segment['last_unix_us'] < start or (end is not None and segment['first_unix_us'] > end):
+            continue
+        index = np.load(segment['index_path'], mmap_mode='r')
+        offset = None
+        if start > segment['first_unix_us']:
+            offset = find_offset(index, start, 'left', segment['index_stride'])
+            if offset is None:
+                continue
+        end_offset = find_offset(index, end, 'right') if end is not None else None
+        yield from read_records(segment['path'], offset, end_offset)
@@ -0,0 +1,183 @@
+# Imports
+import socket
+import struct
+import time
+import numpy as np
+from src import Profiler as P
+
+# Values of the libpcap file format as written by scapy's wrpcap (https://wiki.wireshark.org/Development/LibpcapFileFormat)
+pcap_global_header = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+pcap_record_header = struct.Struct('<IIII')
+
+# Ethernet (14 bytes), IPv4 (20 bytes, no options) and UDP (8 bytes) headers
+eth_header = struct.Struct('!6s6sH')
+ip_header = struct.Struct('!BBHHHBBH4s4s')
+udp_header = struct.Struct('!HHHH')
+header_length = eth_header.size + ip_header.size + udp_header.size
+
+# Addresses of the packets written by PcapWriter, as set by LiDAR.build_packet
+default_eth_s = "60:76:88:20:12:6e"
+default_eth_d = "ff:ff:ff:ff:ff:ff"
+default_ip_s = "192.168.1.201"
+default_ip_d = "255.255.255.255"
+
+
+def checksum_sum(data):
+    '''
+    Sums up the given data as big-endian 16 bit words, as needed for the internet checksum (RFC 1071).
+    :param data: bytes-like object
+    :return: Unfolded sum of all 16 bit words
+    '''
+    words = np.frombuffer(data, dtype=np.uint8)
+    if len(words) % 2:
+        words = np.append(words, np.uint8(0))
+    return int(words.view('>u2').sum(dtype=np.uint64))
+
+
+def fold_checksum(value):
+    '''
+    Folds a sum of 16 bit words to 16 bit and returns its ones' complement.
+    :param value: Sum as returned by checksum_sum
+    :return: 16 bit checksum
+    '''
+    while value >> 16:
+        value = (value & 0xffff) + (value >> 16)
+    return ~value & 0xffff
+
+
+class HeaderTemplate:
+    '''
+    Ethernet/IP/UDP header for one pair of ports. Everything that does not depend on the payload is computed
+    once, so only the length, IP id and checksum fields have to be patched for every packet.
+    '''
+
+    def __init__(self, eth_s, eth_d, ip_s, ip_d, udp_s, udp_d, ttl=64):
+        self.eth = eth_header.pack(bytes.fromhex(eth_d.replace(':', '')), bytes.fromhex(eth_s.replace(':', '')),
+                                   0x0800)
+        self.ip_s = socket.inet_aton(ip_s)
+        self.ip_d = socket.inet_aton(ip_d)
+        self.ttl = ttl
+        self.udp_s = udp_s
+        self.udp_d = udp_d
+
+        # Partial checksums of the constant fields of the ip header and the udp pseudo header
+        self.ip_sum = checksum_sum(ip_header.pack(0x45, 0, 0, 0, 0, ttl, socket.IPPROTO_UDP, 0, self.ip_s, self.ip_d))
+        self.udp_sum = checksum_sum(self.ip_s + self.ip_d) + socket.IPPROTO_UDP + udp_s + udp_d
+
+    def build(self, payload, ip_id=1):
+        '''
+        Builds the 42 byte header for the given payload.
+        :param payload: Payload of the udp packet
+        :param ip_id: Identification field of the ip header. Scapy uses 1 by default.
+        :return: Ethernet, IP and UDP header
+        '''
+        udp_len = udp_header.size + len(payload)
+        ip_len = ip_header.size + udp_len
+
+        ip_chksum = fold_checksum(self.ip_sum + ip_len + ip_id)
+        # The udp length is part of the pseudo header and the udp header, so it is added twice
+        udp_chksum = fold_checksum(self.udp_sum + 2 * udp_len + checksum_sum(payload)) or 0xffff
+
+        return (self.eth
+                + ip_header.pack(0x45, 0, ip_len, ip_id, 0, self.ttl, socket.IPPROTO_UDP, ip_chksum,
+                                 self.ip_s, self.ip_d)
+                + udp_header.pack(self.udp_s, self.udp_d, udp_len, udp_chksum))
+
+
+class PcapWriter:
+    '''
+    Writes udp packets with the given payloads directly to a pcap file. In contrast to scapy's wrpcap no packet
+    objects are created and the packets do not have to be kept in memory, but are streamed to the file as they are
+    written. The output is the same as the one of wrpcap for packets built with LiDAR.build_packet.
+    '''
+
+    def __init__(self, path, eth_s=default_eth_s, eth_d=default_eth_d, ip_s=default_ip_s, ip_d=default_ip_d,
+                 buffer_size=1 << 20):
+        '''
+        :param path: Path of the pcap file
+        :param eth_s: Source MAC address
+        :param eth_d: Destination MAC address
+        :param ip_s: Source IP address
+        :param ip_d: Destination IP address
+        :param buffer_size: Size of the write buffer in bytes
+        '''
+        self.addresses = (eth_s, eth_d, ip_s, ip_d)
+        self.templates = {}
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.file.write(pcap_global_header)
+        self.size = len(pcap_global_header)     # Bytes written so far, i.e. the offset of the next record
+
+    def template(self, udp_s=2368, udp_d=2368):
+        '''
+        Returns the (cached) header template for the given ports.
+        '''
+        key = (udp_s, udp_d)
+        if key not in self.templates:
+            self.templates[key] = HeaderTemplate(*self.addresses, udp_s=udp_s, udp_d=udp_d)
+        return self.templates[key]
+
+    def build_frame(self, payload, udp_s=2368, udp_d=2368, ip_id=1):
+        '''
+        Builds a whole frame which can be written multiple times with write_frame, e.g. for constant payloads
+        such as the position packets.
+        :param payload: Payload of the udp packet
+        :param udp_s: Source UDP port
+        :param udp_d: Destination UDP port
+        :param ip_id: Identification field of the ip header
+        :return: The whole assembled frame as bytes.
+        '''
+        return self.template(udp_s, udp_d).build(payload, ip_id) + bytes(payload)
+
+    def write_frame(self, frame, timestamp=None):
+        '''
+        Writes an already assembled frame as one record.
+        :param frame: Frame as returned by build_frame
+        :param timestamp: Unix timestamp of the record in seconds, the current time is used if not given.
+        '''
+        with P.measure('pcap write', nbytes=len(frame)):
+            self.write_record((frame,), len(frame), timestamp)
+
+    def write(self, payload, udp_s=2368, udp_d=2368, ip_id=1, timestamp=None):
+        '''
+        Writes one udp packet with the given payload. The payload is written without being copied.
+        :param payload: Payload of the udp packet (bytes-like object, e.g. the memoryviews returned by
+                        LiDAR.create_velodyne_payloads)
+        :param udp_s: Source UDP port
+        :param udp_d: Destination UDP port
+        :param ip_id: Identification field of the ip header
+        :param timestamp: Unix timestamp of the record in seconds, the current time is used if not given.
+        '''
+        if P.enabled:
+            self.write_profiled(payload, udp_s, udp_d, ip_id, timestamp)
+            return
+        header = self.template(udp_s, udp_d).build(payload, ip_id)
+        self.write_record((header, payload), len(header) + len(payload), timestamp)
+
+    def write_profiled(self, payload, udp_s, udp_d, ip_id, timestamp):
+        # Same as write, but the framing and the writing are measured as separate stages
+        start = time.perf_counter()
+        header = self.template(udp_s, udp_d).build(payload, ip_id)
+        framed = time.perf_counter()
+        self.write_record((header, payload), len(header) + len(payload), timestamp)
+        written = time.perf_counter()
+        P.record('packet framing', framed - start, framed - start, nbytes=len(header))
+        P.record('pcap write', written - framed, written - framed, nbytes=len(header) + len(payload))
+
+    def write_record(self, parts, length, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        sec = int(timestamp)
+        usec = int(round((timestamp - sec) * 1000000))
+        self.file.write(pcap_record_header.pack(sec, usec, length, length))
+        for part in parts:
+            self.file.write(part)
+        self.size += pcap_record_header.size + length
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,230 @@
+# Imports
+import json
+import os
+import random
+import threading
+import time
+
+# Profiling is off by default, then measure() returns a shared no-op measurement and record() returns at once.
+enabled = False
+stages = {}
+lock = threading.Lock()
+start_time = time.perf_counter()
+
+# Maximum amount of latency samples kept per stage (reservoir sampling) to compute the percentiles
+max_samples = 10000
+
+
+class StageStats:
+    """
+    Accumulated statistics of one pipeline stage.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.bytes = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max = None
+        self.samples = []
+
+    def add(self, wall, cpu, items, nbytes):
+        self.calls += 1
+        self.items += items
+        self.bytes += nbytes
+        self.wall += wall
+        self.cpu += cpu
+        if self.max is None or wall > self.max:
+            self.max = wall
+        if len(self.samples) < max_samples:
+            self.samples.append(wall)
+        else:
+            i = random.randrange(self.calls)
+            if i < max_samples:
+                self.samples[i] = wall
+
+    def merge(self, other):
+        """
+        Adds the statistics of another process. If the samples of both do not fit into the reservoir, each one
+        contributes in proportion to its amount of calls, so the merged samples stay a uniform sample of all calls.
+        """
+        if len(self.samples) + len(other.samples) <= max_samples:
+            self.samples = self.samples + other.samples
+        else:
+            total = self.calls + other.calls
+            own = min(len(self.samples), int(round(max_samples * self.calls / total)))
+            others = min(len(other.samples), max_samples - own)
+            own = min(len(self.samples), max_samples - others)
+            self.samples = random.sample(self.samples, own) + random.sample(other.samples, others)
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        self.calls += other.calls
+        self.items += other.items
+        self.bytes += other.bytes
+        self.wall += other.wall
+        self.cpu += other.cpu
+
+    def summary(self, elapsed):
+        samples = sorted(self.samples)
+
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))] * 1000 if samples \
+                else None
+
+        return {'calls': self.calls, 'items': self.items, 'bytes': self.bytes,
+                'wall_s': self.wall, 'cpu_s': self.cpu,
+                'items_per_s': self.items / self.wall if self.wall > 0 else None,
+                'mb_per_s': self.bytes / 1e6 / self.wall if self.wall > 0 else None,
+                'share_of_run': self.wall / elapsed if elapsed > 0 else None,
+                'latency_ms': {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99),
+                               'max': self.max * 1000 if self.max is not None else None}}
+
+
+class Measurement:
+    """
+    Context manager measuring wall and cpu time of one call of a stage. 'items' and 'nbytes' can be set while
+    the measurement is running, e.g. once the size of a decoded image is known.
+    """
+
+    def __init__(self, name, items=1, nbytes=0):
+        self.name = name
+        self.items = items
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            record(self.name, time.perf_counter() - self.wall, time.thread_time() - self.cpu, self.items,
+                   self.nbytes)
+
+
+class NullMeasurement:
+    """
+    Measurement used when profiling is off.
+    """
+    items = 0
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __setattr__(self, key, value):
+        pass
+
+
+null_measurement = NullMeasurement()
+
+
+def enable(progress_interval=0):
+    """
+    Enables the profiling of the current process.
+    :param progress_interval: If greater than 0, a progress line is printed every progress_interval seconds
+    """
+    global enabled, start_time
+    enabled = True
+    start_time = time.perf_counter()
+    if progress_interval > 0:
+        thread = threading.Thread(target=print_progress, args=(progress_interval,), daemon=True)
+        thread.start()
+
+
+def init_worker(profile):
+    """
+    Initializer of pool workers, which profile their stages if the main process does.
+    """
+    global enabled
+    enabled = profile
+    stages.clear()
+
+
+def measure(name, items=1, nbytes=0):
+    """
+    Returns a context manager which measures one call of a stage.
+    :param name: Name of the stage (e.g. 'png decode')
+    :param items: Amount of items (e.g. packets or frames) processed by the call
+    :param nbytes: Amount of bytes processed by the call
+    """
+    if not enabled:
+        return null_measurement
+    return Measurement(name, items, nbytes)
+
+
+def record(name, wall, cpu=0.0, items=1, nbytes=0):
+    """
+    Adds one call of a stage, which was measured by the caller.
+    """
+    if not enabled:
+        return
+    with lock:
+        stats = stages.get(name)
+        if stats is None:
+            stats = stages[name] = StageStats()
+        stats.add(wall, cpu, items, nbytes)
+
+
+def take():
+    """
+    Returns the statistics collected so far and resets them. Used by pool workers to send their statistics to the
+    main process.
+    :return: Dictionary stage name -> StageStats or None if profiling is off
+    """
+    if not enabled:
+        return None
+    with lock:
+        collected = dict(stages)
+        stages.clear()
+    return collected
+
+
+def merge(collected):
+    """
+    Adds the statistics returned by take() in another process.
+    """
+    if not collected:
+        return
+    with lock:
+        for name, other in collected.items():
+            stats = stages.get(name)
+            if stats is None:
+                stages[name] = other
+            else:
+                stats.merge(other)
+
+
+def summary():
+    """
+    :return: Dictionary with the elapsed time and the statistics of all stages
+    """
+    elapsed = time.perf_counter() - start_time
+    with lock:
+        return {'elapsed_s': elapsed, 'stages': {name: stats.summary(elapsed) for name, stats in stages.items()}}
+
+
+def write_summary(path):
+    """
+    Writes the summary as json.
+    :param path: Path of the json file
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(summary(), f, indent=2)
+
+
+def print_progress(interval):
+    while True:
+        time.sleep(interval)
+        elapsed = time.perf_counter() - start_time
+        with lock:
+            parts = ['{}: {} ({:.0f}/s)'.format(name, stats.items, stats.items / elapsed)
+                     for name, stats in stages.items()]
+        print('[{:.0f} s] {}'.format(elapsed, ', '.join(parts)), flush=True)
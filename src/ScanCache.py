@@ -0,0 +1,79 @@
+# Imports
+import hashlib
+import json
+import os
+import numpy as np
+from src import LiDAR as LI
+
+# Arrays returned by LiDAR.load_velodyne_raw, in this order
+scan_arrays = ('ranges', 'intensities', 'angles', 'timestamps')
+meta_name = 'source.json'
+
+
+def cache_entry_path(cache_dir, velodyne_raw_path):
+    '''
+    Every source file has its own directory in the cache, named after the hash of its absolute path.
+    :param cache_dir: Root directory of the cache
+    :param velodyne_raw_path: Path to the raw Velodyne example
+    :return: Path to the cache directory of the source file
+    '''
+    key = hashlib.sha1(os.path.abspath(velodyne_raw_path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def source_info(velodyne_raw_path):
+    stat = os.stat(velodyne_raw_path)
+    return {'path': os.path.abspath(velodyne_raw_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def load_velodyne_cached(velodyne_raw_path, cache_dir):
+    '''
+    Same as LiDAR.load_velodyne_raw, but the decoded arrays are stored in a cache as .npy files. If the cache
+    contains the arrays of the unchanged source file (same path, size and mtime), they are memory-mapped instead
+    of decoding the png again. Changed source files are decoded again and replace the old cache entry.
+    :param velodyne_raw_path: Path to the raw Velodyne example (of the form '<timestamp>.png')
+    :param cache_dir: Root directory of the cache
+    :return: ranges, intensities, angles and timestamps as returned by LiDAR.load_velodyne_raw (read-only)
+    '''
+    if not os.path.isfile(velodyne_raw_path):
+        raise FileNotFoundError("Could not find velodyne raw example: {}".format(velodyne_raw_path))
+
+    info = source_info(velodyne_raw_path)
+    entry = cache_entry_path(cache_dir, velodyne_raw_path)
+    meta_path = os.path.join(entry, meta_name)
+
+    try:
+        with open(meta_path) as f:
+            if json.load(f) == info:
+                return tuple(np.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in scan_arrays)
+    except (OSError, ValueError):
+        pass
+
+    arrays = LI.load_velodyne_raw(velodyne_raw_path)
+    store_entry(entry, info, arrays)
+    return arrays
+
+
+def store_entry(entry, info, arrays):
+    '''
+    Writes the arrays of one source file to its cache directory. The meta file is removed first and written last,
+    so an interrupted write never leaves a valid looking entry behind.
+    :param entry: Cache directory of the source file
+    :param info: Source file information as returned by source_info
+    :param arrays: Arrays in the order of scan_arrays
+    '''
+    os.makedirs(entry, exist_ok=True)
+    meta_path = os.path.join(entry, meta_name)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    suffix = '.{}.tmp'.format(os.getpid())
+    for name, array in zip(scan_arrays, arrays):
+        path = os.path.join(entry, name + '.npy')
+        with open(path + suffix, 'wb') as f:
+            np.save(f, array)
+        os.replace(path + suffix, path)
+
+    with open(meta_path + suffix, 'w') as f:
+        json.dump(info, f)
+    os.replace(meta_path + suffix, meta_path)
@@ -0,0 +1,332 @@
+# Imports
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src import FramePipeline as FP
+from src import FrameTiming as FT
+from src import GStreamer as GS
+from src import LiDARPool as LP
+from src import Profiler as P
+from src.UdpReplay import UdpSender, replay_statistics
+from src.VideoConverter import pix_fmt_of
+
+# The ratio of data to position packets of the Velodyne HDL-32E is 14:1
+position_packet_interval = 15
+
+
+class ReplayClock:
+    '''
+    Clock shared by all sensors of a replay. A timestamp of the dataset is due at the time it has relative to the
+    epoch (the first timestamp of all sensors), divided by the speed multiplier.
+    '''
+
+    def __init__(self, epoch, speed=1.0):
+        '''
+        :param epoch: Timestamp in microseconds which is due when the clock is started
+        :param speed: Speed multiplier, 2.0 replays twice as fast as recorded
+        '''
+        if speed <= 0:
+            raise Exception("The replay speed has to be greater than 0.")
+        self.epoch = epoch
+        self.speed = speed
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+
+    def due(self, timestamp):
+        '''
+        :param timestamp: Timestamp of the dataset in microseconds
+        :return: perf_counter time at which the timestamp is due
+        '''
+        return self.start_time + (timestamp - self.epoch) / 1000000 / self.speed
+
+    async def wait(self, timestamp):
+        delay = self.due(timestamp) - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class LidarSource:
+    '''
+    Packets of the scans of one Velodyne directory, sent via udp like a live sensor. Packets which are due within
+    batch_window are sent together in one batch (see UdpSender.send_batch).
+    '''
+
+    def __init__(self, name, scan_files, dst_address, data_port=2368, position_port=8308, position_payload=None,
+                 workers=1, cache_dir=None, batch_window=0.001):
+        '''
+        :param name: Name of the sensor, e.g. velodyne_left
+        :param scan_files: Paths to the raw Velodyne scans (of the form '<timestamp>.png') in temporal order
+        :param dst_address: IPv4 address to which the packets are sent
+        :param data_port: Destination port of the data packets
+        :param position_port: Destination port of the position packets
+        :param position_payload: Payload of the position packets, no position packets are sent if not given
+        :param workers: Amount of processes used to decode and encode the scans
+        :param cache_dir: Root directory of the decoded-scan cache (see ScanCache), not used if not given
+        :param batch_window: Maximum time in seconds between the first and the last packet of a batch
+        '''
+        self.name = name
+        self.scan_files = scan_files
+        self.dst_address = dst_address
+        self.data_port = data_port
+        self.position_port = position_port
+        self.position_payload = bytes(position_payload) if position_payload else None
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.batch_window = batch_window
+        self.senders = {}
+
+    def events(self, speed=1.0):
+        '''
+        Generator yielding the packets in batches. The payloads are copied, since the buffers of encode_scans are
+        only valid until the next scan is requested, but the batches are read ahead.
+        :param speed: Speed multiplier of the replay, which determines how many packets fit into batch_window
+        :return: Generator of tuples (timestamp of the first packet in microseconds, list of (port, payload))
+        '''
+        window = self.batch_window * 1000000 * speed
+        counter = 1
+        batch, batch_timestamp = [], None
+        scans = LP.encode_scans(self.scan_files, workers=self.workers, cache_dir=self.cache_dir)
+        try:
+            for payloads, timestamps in scans:
+                for p, payload in enumerate(payloads):
+                    timestamp = int(timestamps[0, p])
+                    if batch and timestamp - batch_timestamp > window:
+                        yield batch_timestamp, batch
+                        batch = []
+                    if not batch:
+                        batch_timestamp = timestamp
+                    if self.position_payload and counter % position_packet_interval == 0:
+                        batch.append((self.position_port, self.position_payload))
+                    batch.append((self.data_port, bytes(payload)))
+                    counter += 1
+            if batch:
+                yield batch_timestamp, batch
+        finally:
+            scans.close()
+
+    def dispatch(self, batch):
+        ports = {}
+        for port, payload in batch:
+            ports.setdefault(port, []).append(payload)
+        for port, payloads in ports.items():
+            if port not in self.senders:
+                self.senders[port] = UdpSender(self.dst_address, port)
+            self.senders[port].send_batch(payloads)
+        return len(batch)
+
+    def prepare(self, batch):
+        pass
+
+    def close(self, error=False):
+        for sender in self.senders.values():
+            sender.close()
+        self.senders = {}
+
+
+class CameraSource:
+    '''
+    Frames of one camera directory, streamed over RTP (see GStreamer.LiveStreamer). The frames are processed ahead
+    in memory, a frame which is more than max_lag seconds late is dropped like in GStreamer.stream_frames.
+    '''
+
+    def __init__(self, name, image_path, destinations, model_path=None, rectify=False, factor=None, size=None,
+                 workers=1, bitrate=4000, max_lag=None, timestamps_path=None):
+        '''
+        :param name: Name of the sensor, e.g. stereo/centre
+        :param image_path: Path to the directory where the images ('<timestamp>.png') reside
+        :param destinations: List of tuples (host, port) to which the stream is sent
+        :param model_path: Path to the camera models that are contained in the robotcar_dataset_sdk
+        :param rectify: Perform Bayer demosaicing and undistortion
+        :param factor: factor to scale images up and down
+        :param size: explicit size of the form (W, H), to which the images should be resized
+        :param workers: Amount of processes used to process the frames
+        :param bitrate: Bitrate of the encoder in kbit/s
+        :param max_lag: Maximum lag of a frame in seconds, one frame interval if not given
+        :param timestamps_path: Timestamps file of the camera, so the frames are timed like the lidar scans by the
+                                timestamps of the dataset (see FrameTiming.frame_timestamps). The names of the
+                                images are used if not given.
+        '''
+        self.name = name
+        self.image_path = image_path
+        self.destinations = destinations
+        self.processor_args = (model_path, rectify, factor, size)
+        self.workers = workers
+        self.bitrate = bitrate
+        self.max_lag = max_lag
+        self.image_list, timestamps = FT.frame_timestamps(FP.list_images(image_path), timestamps_path)
+        self.timestamps = timestamps.tolist()
+        self.frame_rate = FT.nominal_frame_rate(self.timestamps)
+        self.streamer = None
+
+    def events(self, speed=1.0):
+        '''
+        :param speed: Speed multiplier of the replay, which determines the frame rate of the stream
+        :return: Generator of tuples (timestamp in microseconds, processed frame)
+        '''
+        self.frame_rate = FT.nominal_frame_rate(self.timestamps) * speed
+        if self.max_lag is None:
+            self.max_lag = 1 / self.frame_rate
+        return self.frames()
+
+    def frames(self):
+        frames = FP.process_frames(self.image_path, self.image_list, *self.processor_args, workers=self.workers)
+        try:
+            yield from zip(self.timestamps, frames)
+        finally:
+            frames.close()
+
+    def prepare(self, frame):
+        '''
+        Starts the encoder with the size of the first frame before the clock is started, so its startup time does
+        not delay the first frames.
+        '''
+        self.streamer = GS.LiveStreamer(self.destinations, frame.shape[1], frame.shape[0], pix_fmt_of(frame),
+                                        self.frame_rate, self.bitrate)
+
+    def dispatch(self, frame):
+        if self.streamer is None:
+            self.prepare(frame)
+        self.streamer.write(frame)
+        return 1
+
+    def close(self, error=False):
+        if self.streamer is not None:
+            if error:
+                self.streamer.abort()
+            else:
+                self.streamer.close()
+            self.streamer = None
+
+
+class SensorState:
+    '''
+    Read-ahead queue and statistics of one sensor during a replay.
+    '''
+
+    def __init__(self, source, read_ahead):
+        self.source = source
+        # One thread reads the events and one dispatches them, since sending a batch (which waits while the socket
+        # buffer is full) or writing a frame (while the encoder is busy) blocks. Using a single thread each also
+        # keeps the calls of the event generator serialized, e.g. closing it after a cancelled read.
+        self.reader = ThreadPoolExecutor(max_workers=1)
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.queue = asyncio.Queue(maxsize=read_ahead)
+        self.ready = asyncio.Event()
+        self.first = None
+        self.lags = []
+        self.items = 0
+        self.dropped = 0
+
+
+async def read_events(state, events, loop):
+    '''
+    Pulls the events of a sensor in a worker thread, so decoding and disk I/O never block the event loop, and
+    keeps up to read_ahead of them in the queue. None marks the end of the events.
+    '''
+    try:
+        while True:
+            event = await loop.run_in_executor(state.reader, next, events, None)
+            await state.queue.put(event)
+            if state.first is None:
+                state.first = event
+            state.ready.set()
+            if event is None:
+                break
+    except BaseException:
+        await state.queue.put(None)
+        state.ready.set()
+        raise
+
+
+async def dispatch_events(state, clock, loop):
+    '''
+    Dispatches the events of a sensor at the time given by their timestamps on the shared clock. The events are
+    dispatched by the writer thread of the sensor, so a blocked output only delays its own sensor.
+    '''
+    source = state.source
+    max_lag = getattr(source, 'max_lag', None)
+    while True:
+        event = await state.queue.get()
+        if event is None:
+            break
+        timestamp, data = event
+        await clock.wait(timestamp)
+
+        due = clock.due(timestamp)
+        if max_lag is not None and time.perf_counter() - due > max_lag:
+            state.dropped += 1
+            continue
+        items = await loop.run_in_executor(state.writer, source.dispatch, data)
+        # The lag of a batch is the one of its first item, which is due first
+        lag = time.perf_counter() - due
+        state.lags.append(lag)
+        state.items += items
+        P.record('{} dispatch'.format(source.name), lag, items=items)
+
+
+async def replay_sources(sources, speed=1.0, read_ahead=32):
+    states = [SensorState(source, read_ahead) for source in sources]
+    clock = None
+    loop = asyncio.get_event_loop()
+
+    event_iterators = [source.events(speed) for source in sources]
+    tasks = []
+    error = True
+    try:
+        for state, events in zip(states, event_iterators):
+            tasks.append(asyncio.ensure_future(read_events(state, events, loop)))
+
+        # The clock is started once every sensor has its first events in memory, so the first scan or frame to be
+        # decoded does not show up as lag. Its epoch is the earliest of their timestamps, sensors without events
+        # (e.g. a lidar without scans) are skipped.
+        await asyncio.gather(*(state.ready.wait() for state in states))
+        active = [state for state in states if state.first is not None]
+        for state in active:
+            await loop.run_in_executor(state.writer, state.source.prepare, state.first[1])
+        clock = ReplayClock(min((state.first[0] for state in active), default=0), speed)
+        clock.start()
+        for state in active:
+            tasks.append(asyncio.ensure_future(dispatch_events(state, clock, loop)))
+        await asyncio.gather(*tasks)
+        error = False
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for state, events in zip(states, event_iterators):
+            await loop.run_in_executor(state.reader, events.close)
+            await loop.run_in_executor(state.writer, state.source.close, error)
+            state.reader.shutdown()
+            state.writer.shutdown()
+
+    duration = time.perf_counter() - clock.start_time if clock else 0.0
+    return {source.name: dict(replay_statistics(state.lags, duration), items=state.items, dropped=state.dropped)
+            for source, state in zip(sources, states)}
+
+
+def replay(sources, speed=1.0, read_ahead=32):
+    '''
+    Replays several sensors together on one shared clock. The events of all sensors (batches of lidar packets and
+    camera frames) are dispatched in the order of their timestamps, each at the time it has relative to the earliest
+    timestamp of all sensors. The events are read ahead in worker threads, so disk I/O does not stall the clock.
+    :param sources: List of LidarSource and CameraSource objects
+    :param speed: Speed multiplier, 2.0 replays twice as fast as recorded
+    :param read_ahead: Maximum amount of events per sensor held in memory
+    :return: Dictionary sensor name -> statistics. 'packets' is the amount of dispatched events (frames or batches
+             of packets), 'items' the amount of frames or packets. The lag of the events is their skew against the
+             ideal schedule, see UdpReplay.replay_statistics.
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(replay_sources(sources, speed, read_ahead))
+    finally:
+        loop.close()
+
+
+def format_statistics(name, stats):
+    return ('{}: {} events ({} items, {} dropped late) in {:.2f} s, skew mean {:.3f} ms, p99 {:.3f} ms, '
+            'max {:.3f} ms, jitter {:.3f} ms.'.format(name, stats['packets'], stats['items'], stats['dropped'],
+                                                     stats['duration_s'], stats['lag_mean_ms'], stats['lag_p99_ms'],
+                                                     stats['lag_max_ms'], stats['jitter_ms']))
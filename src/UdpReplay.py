@@ -0,0 +1,247 @@
+# Imports
+import ctypes
+import errno
+import os
+import select
+import socket
+import struct
+import time
+import numpy as np
+from src import Profiler as P
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+# sendmmsg is only available on linux, on other platforms the packets of a batch are sent one by one.
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    sendmmsg = libc.sendmmsg
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+except (OSError, AttributeError):
+    sendmmsg = None
+
+# Time in seconds to wait before a batch is sent again after the socket or interface buffer was full
+retry_wait = 0.0005
+
+
+class UdpSender:
+    '''
+    UDP socket for one destination, which sends a whole batch of datagrams with a single sendmmsg call.
+    '''
+
+    def __init__(self, dst_address, dst_port, src_port=None):
+        '''
+        :param dst_address: IPv4 address to which the packets are sent (broadcast addresses are allowed)
+        :param dst_port: Destination UDP port
+        :param src_port: Source UDP port, chosen by the os if not given
+        '''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 << 20)
+        if src_port is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(('', src_port))
+        self.destination = (dst_address, dst_port)
+
+        # The socket is not connected, so missing receivers (icmp port unreachable) do not cause send errors.
+        # The destination is given with every message as struct sockaddr_in instead.
+        self.sockaddr = ctypes.create_string_buffer(struct.pack('=H', socket.AF_INET) + struct.pack('!H', dst_port)
+                                                    + socket.inet_aton(dst_address) + bytes(8), 16)
+
+    def send_batch(self, payloads):
+        '''
+        Sends all given payloads as separate datagrams.
+        :param payloads: List of bytes-like objects
+        '''
+        if sendmmsg is None:
+            for payload in payloads:
+                self.sock.sendto(payload, self.destination)
+            return
+
+        count = len(payloads)
+        data = (ctypes.c_char * sum(len(p) for p in payloads)).from_buffer_copy(b''.join(payloads))
+        base = ctypes.addressof(data)
+        iovecs = (iovec * count)()
+        msgs = (mmsghdr * count)()
+        offset = 0
+        for i, payload in enumerate(payloads):
+            iovecs[i].iov_base = base + offset
+            iovecs[i].iov_len = len(payload)
+            msgs[i].msg_hdr.msg_name = ctypes.addressof(self.sockaddr)
+            msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(self.sockaddr)
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+            offset += len(payload)
+
+        sent = 0
+        while sent < count:
+            res = sendmmsg(self.sock.fileno(), ctypes.addressof(msgs) + sent * ctypes.sizeof(mmsghdr), count - sent, 0)
+            if res < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err == errno.EAGAIN:
+                    # The socket buffer is full, wait until it drains instead of retrying in a busy loop
+                    select.select([], [self.sock], [], retry_wait)
+                    continue
+                if err == errno.ENOBUFS:
+                    # The queue of the interface is full, the socket itself still reports to be writable
+                    time.sleep(retry_wait)
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += res
+
+    def close(self):
+        self.sock.close()
+
+
+class UdpReplayer:
+    '''
+    Sends packets like a live sensor does. Every packet is sent at the time given by its timestamp relative to the
+    first packet (divided by the speed multiplier). Packets which are due within batch_window are sent together in
+    one batch per destination port.
+    '''
+
+    def __init__(self, dst_address, speed=1.0, batch_window=0.001, max_batch=64, src_ports=False):
+        '''
+        :param dst_address: IPv4 address to which the packets are sent
+        :param speed: Speed multiplier, 2.0 replays twice as fast as recorded
+        :param batch_window: Packets due within this amount of seconds are sent in one batch (so they may be sent
+                             up to batch_window seconds early, which shows up as negative lag)
+        :param max_batch: Maximum amount of packets per batch
+        :param src_ports: If True the source port equals the destination port, as for the real sensor. Do not use it
+                          together with a receiver on the same host, since it would receive the packets itself.
+        '''
+        if speed <= 0:
+            raise Exception("The replay speed has to be greater than 0.")
+        self.dst_address = dst_address
+        self.speed = speed
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.src_ports = src_ports
+        self.senders = {}
+
+        self.first_timestamp = None
+        self.start_time = None
+        self.batch = []     # List of (scheduled time, port, payload)
+        self.lags = []      # Difference between send time and scheduled time of every packet in seconds
+
+    def sender(self, port):
+        if port not in self.senders:
+            self.senders[port] = UdpSender(self.dst_address, port, port if self.src_ports else None)
+        return self.senders[port]
+
+    def send(self, payload, timestamp, port=2368):
+        '''
+        Queues the payload to be sent at the time given by its timestamp.
+        :param payload: Payload of the udp packet
+        :param timestamp: Unix timestamp of the packet in microseconds
+        :param port: Destination UDP port (2368 for data and 8308 for position packets)
+        '''
+        now = time.perf_counter()
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+            self.start_time = now
+        scheduled = self.start_time + (timestamp - self.first_timestamp) / 1000000 / self.speed
+
+        if self.batch and (scheduled - self.batch[0][0] > self.batch_window or len(self.batch) >= self.max_batch):
+            self.flush()
+        self.batch.append((scheduled, port, bytes(payload)))
+
+    def flush(self):
+        '''
+        Waits until the first packet of the current batch is due and sends the whole batch.
+        '''
+        if not self.batch:
+            return
+
+        delay = self.batch[0][0] - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        ports = {}
+        for _, port, payload in self.batch:
+            ports.setdefault(port, []).append(payload)
+        for port, payloads in ports.items():
+            with P.measure('udp send', items=len(payloads), nbytes=sum(len(payload) for payload in payloads)):
+                self.sender(port).send_batch(payloads)
+
+        sent = time.perf_counter()
+        self.lags.extend(sent - scheduled for scheduled, _, _ in self.batch)
+        self.batch = []
+
+    def close(self):
+        '''
+        Sends the remaining packets, closes the sockets and returns the statistics of the replay.
+        :return: Dictionary with the statistics, see replay_statistics
+        '''
+        self.flush()
+        for sender in self.senders.values():
+            sender.close()
+        self.senders = {}
+        return replay_statistics(self.lags, time.perf_counter() - self.start_time if self.start_time else 0.0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def replay_statistics(lags, duration):
+    '''
+    Summarizes the lag of the sent packets. The lag is the time between the scheduled and the actual sending of a
+    packet, the jitter is the standard deviation of the lag. A replay kept real-time, if the lag does not grow.
+    :param lags: Lag of every sent packet in seconds
+    :param duration: Duration of the replay in seconds
+    :return: Dictionary with amount of packets, packet rate, lag (mean, p99, max) and jitter in milliseconds
+    '''
+    num_packets = len(lags)
+    lags = np.asarray(lags, dtype=np.float64) * 1000 if num_packets else np.zeros(1)
+    return {'packets': num_packets,
+            'duration_s': duration,
+            'packets_per_s': num_packets / duration if duration > 0 else 0.0,
+            'lag_mean_ms': float(lags.mean()),
+            'lag_p99_ms': float(np.percentile(lags, 99)),
+            'lag_max_ms': float(lags.max()),
+            'jitter_ms': float(lags.std())}
+
+
+def start_udp_receiver(port, timeout=1.0, address=''):
+    '''
+    Simple receiver which can be used instead of a real consumer to test the replay on the loopback interface.
+    It receives packets on the given port until no packet arrived for 'timeout' seconds.
+    :param port: UDP port on which the packets are received
+    :param timeout: Time in seconds after which the receiver stops if no packets arrive
+    :param address: Address to which the receiver socket is bound
+    :return: List of received payloads
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    sock.bind((address, port))
+    sock.settimeout(timeout)
+
+    payloads = []
+    try:
+        while True:
+            payloads.append(sock.recv(65535))
+    except socket.timeout:
+        pass
+    finally:
+        sock.close()
+    return payloads
@@ -0,0 +1,132 @@
+# Imports
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from src import Profiler as P
+
+default_endpoint = "http://localhost:5000/model/predict"
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+
+class UpscaleClient:
+    """
+    Client for the max-image-resolution-enhancer (https://github.com/IBM/MAX-Image-Resolution-Enhancer).
+    Up to 'concurrency' requests are in flight at the same time, distributed round-robin over the given endpoints.
+    Every thread keeps its own session, so the http connections are reused between requests.
+    """
+
+    def __init__(self, endpoints=(default_endpoint,), concurrency=4, retries=3, timeout=120, backoff=1.0):
+        """
+        :param endpoints: URLs of the predict route of one or more running services
+        :param concurrency: Amount of requests in flight at the same time
+        :param retries: Amount of retries of a failed request (connection errors, timeouts and server errors)
+        :param timeout: Timeout of a request in seconds
+        :param backoff: Time in seconds to wait before the first retry, doubled for every further retry
+        """
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+        if not endpoints:
+            raise Exception("At least one endpoint of the upscaling service has to be given.")
+        self.endpoints = list(endpoints)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.next_endpoint = itertools.cycle(self.endpoints)
+        self.endpoint_lock = threading.Lock()
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+        return self.local.session
+
+    def endpoint(self):
+        with self.endpoint_lock:
+            return next(self.next_endpoint)
+
+    def upscale(self, data, name='image.png'):
+        """
+        Sends one image to the service and returns the upscaled image. Failed requests are retried on the next
+        endpoint.
+        :param data: Content of the png image
+        :param name: File name sent with the image
+        :return: Content of the upscaled png image
+        """
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            endpoint = self.endpoint()
+            try:
+                response = self.session().post(endpoint, files={'image': (name, data, 'image/png')},
+                                               headers={'accept': 'application/json'}, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = e
+                continue
+
+            if response.status_code >= 500:
+                error = Exception("{} returned status {}.".format(endpoint, response.status_code))
+                continue
+            if response.status_code != 200:
+                # Client errors (e.g. an invalid image) will not succeed on a retry
+                raise Exception("{} returned status {}: {}".format(endpoint, response.status_code,
+                                                                   response.text[:200]))
+            if not response.content.startswith(png_signature):
+                error = Exception("{} did not return a png image.".format(endpoint))
+                continue
+            return response.content
+
+        raise Exception("Upscaling {} failed after {} attempts: {}".format(name, self.retries + 1, error))
+
+    def upscale_file(self, input_file, output_file=None):
+        """
+        Upscales one image file. The result is written to a hidden temporary file, which replaces output_file only
+        if the request succeeded, so a failed request never leaves a broken image behind.
+        :param input_file: Path to the png image
+        :param output_file: Path of the upscaled image, input_file is replaced if not given
+        """
+        if output_file is None:
+            output_file = input_file
+        with open(input_file, 'rb') as f:
+            data = f.read()
+        with P.measure('upscale', nbytes=len(data)):
+            result = self.upscale(data, os.path.basename(input_file))
+
+        # Hidden like the temporary files of FramePipeline.save_frame, so a file left behind by a killed run is
+        # neither read as a frame nor counted as a cache entry
+        directory, name = os.path.split(output_file)
+        tmp_file = os.path.join(directory, ".{}.{}.{}.tmp".format(name, os.getpid(), threading.get_ident()))
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(result)
+            os.replace(tmp_file, output_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+    def upscale_files(self, files):
+        """
+        Upscales the given files concurrently.
+        :param files: Iterable of tuples (input file, output file)
+        :return: List of tuples (input file, exception) of the images which failed
+        """
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.upscale_file, input_file, output_file): input_file
+                       for input_file, output_file in files}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append((futures[future], e))
+        return failed
@@ -1,5 +1,12 @@
 # Imports
 import os
+import subprocess
+import tempfile
+import threading
+import numpy as np
+from PIL import Image
+from src import FrameTiming as FT
+from src import Profiler as P
 
 
 def rename_pics(path):
@@ -55,13 +62,275 @@ def images_to_video(path, video_ext, frame_rate):
     os.system("ffmpeg -r {} -i {} out/{}".format(frame_rate, pic_format, vid_format))
 
 
-def convert_to_video(path, video_ext="mp4", frame_rate=25):
+class VideoWriter:
     """
-    This method combines the two previous methods in order to generate a video file.
+    Encodes frames to a video by writing them as raw video into the stdin pipe of an ffmpeg subprocess. Writes block
+    while ffmpeg is busy (backpressure of the pipe), so at most one pipe buffer of frames is held in memory.
+    """
+
+    def __init__(self, output, width, height, pix_fmt='rgb24', frame_rate=25, encoder=None, preset=None):
+        """
+        :param output: Path of the video, the format is derived from its extension
+        :param width: Width of the frames
+        :param height: Height of the frames
+        :param pix_fmt: Pixel format of the frames written (gray, rgb24 or rgba)
+        :param frame_rate: Frame rate of the video
+        :param encoder: ffmpeg video encoder (e.g. libx264, libx265, h264_nvenc), ffmpeg's default if not given
+        :param preset: Encoder preset (e.g. ultrafast, medium, veryslow), encoder's default if not given
+        """
+        command = ['ffmpeg', '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-s', '{}x{}'.format(width, height),
+                   '-r', str(frame_rate), '-i', '-']
+        if encoder:
+            command += ['-c:v', encoder]
+        if preset:
+            command += ['-preset', preset]
+        command.append(output)
+        self.start(command, output, width, height, pix_fmt)
+
+    def start(self, command, output, width, height, pix_fmt):
+        """
+        Starts the encoder subprocess, which reads the raw frames from its stdin. Subclasses call it with their own
+        command instead of the ffmpeg one.
+        :param command: Command of the encoder
+        :param output: Description of the output used in error messages, e.g. the path of the video
+        """
+        self.output = output
+        self.frame_shape = (height, width) if pix_fmt == 'gray' else (height, width, 4 if pix_fmt == 'rgba' else 3)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE)
+        # stderr is drained in the background, otherwise the encoder could block on a full stderr pipe
+        self.stderr = []
+        self.stderr_thread = threading.Thread(target=self.drain_stderr, daemon=True)
+        self.stderr_thread.start()
+
+    def drain_stderr(self):
+        for line in self.process.stderr:
+            self.stderr.append(line.decode('utf-8', errors='replace'))
+
+    def error(self):
+        return Exception("ffmpeg failed to encode {} (exit code {}): {}".format(
+            self.output, self.process.returncode, ''.join(self.stderr[-10:]).strip()))
+
+    def write(self, frame):
+        """
+        Writes one frame.
+        :param frame: numpy array of shape (H, W) for gray or (H, W, C) for rgb24/rgba frames
+        """
+        if frame.shape != self.frame_shape:
+            raise Exception("Frame of shape {} does not match the video shape {}.".format(frame.shape,
+                                                                                          self.frame_shape))
+        try:
+            with P.measure('video encode', nbytes=frame.nbytes):
+                self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        except BrokenPipeError:
+            self.process.wait()
+            self.stderr_thread.join()
+            raise self.error()
+
+    def close(self):
+        """
+        Finishes the video and raises an exception if ffmpeg failed.
+        """
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.stderr_thread.join()
+        if self.process.returncode != 0:
+            raise self.error()
+
+    def abort(self):
+        """
+        Stops ffmpeg without finishing the video, e.g. after an error while producing the frames.
+        """
+        self.process.kill()
+        self.process.wait()
+        self.stderr_thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def sorted_by_timestamp(image_list):
+    """
+    Sorts images named '<timestamp>.png' by their timestamp, other names are sorted alphabetically after them.
+    """
+    def key(name):
+        stem = os.path.splitext(name)[0]
+        return (0, int(stem), name) if stem.isdigit() else (1, 0, name)
+    return sorted(image_list, key=key)
+
+
+def pix_fmt_of(frame):
+    if frame.ndim == 2:
+        return 'gray'
+    return {3: 'rgb24', 4: 'rgba'}[frame.shape[2]]
+
+
+def frames_to_video(frames, output, frame_rate=25, encoder=None, preset=None):
+    """
+    Encodes the given frames to a video. The size and pixel format are taken from the first frame.
+    :param frames: Iterable of frames as numpy arrays
+    :param output: Path of the video
+    :param frame_rate: frame rate of the video
+    :param encoder: ffmpeg video encoder, ffmpeg's default if not given
+    :param preset: Encoder preset, encoder's default if not given
+    """
+    writer = None
+    try:
+        for frame in frames:
+            if writer is None:
+                writer = VideoWriter(output, frame.shape[1], frame.shape[0], pix_fmt_of(frame), frame_rate,
+                                     encoder, preset)
+            writer.write(frame)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    if writer is not None:
+        writer.close()
+
+
+def read_frames(path, image_list):
+    for image_name in image_list:
+        with P.measure('png decode') as m:
+            with Image.open(path + image_name) as im:
+                frame = np.array(im.convert('RGB') if im.mode not in ('L', 'RGB', 'RGBA') else im)
+            m.nbytes = frame.nbytes
+        yield frame
+
+
+def stream_to_video(path, video_ext="mp4", frame_rate=25, encoder=None, preset=None):
+    """
+    Generates a video of the images in path without renaming them. The images are decoded in timestamp order and
+    piped to ffmpeg as raw video, so every image is only decoded once. Every image is shown for 1 / frame_rate
+    seconds, regardless of its timestamp.
 
     :param path: path to the images
     :param video_ext: output format of the video (e.g. mp4, mov, wmv, flv, avi, webm, mkv, ...)
     :param frame_rate: frame rate of the video
+    :param encoder: ffmpeg video encoder (e.g. libx264), ffmpeg's default for the format if not given
+    :param preset: Encoder preset (e.g. ultrafast), encoder's default if not given
     """
-    rename_pics(path)
-    images_to_video(path, video_ext, frame_rate)
+    image_list = sorted_by_timestamp([x for x in os.listdir(path) if not x.startswith('.')])
+    frames_to_video(read_frames(path, image_list), video_output(path, video_ext), frame_rate, encoder, preset)
+
+
+def resample_to_video(path, video_ext="mp4", frame_rate=None, encoder=None, preset=None, timestamps_path=None):
+    """
+    Generates a constant frame rate video of the images in path, which keeps the timing of the recording. The
+    images are resampled to the frame rate by blending the images around every output frame, see
+    FrameTiming.resample_frames.
+
+    :param path: path to the images
+    :param video_ext: output format of the video (e.g. mp4, mov, wmv, flv, avi, webm, mkv, ...)
+    :param frame_rate: frame rate of the video, the nominal frame rate of the camera if not given
+    :param encoder: ffmpeg video encoder (e.g. libx264), ffmpeg's default for the format if not given
+    :param preset: Encoder preset (e.g. ultrafast), encoder's default if not given
+    :param timestamps_path: timestamps file of the camera, the names of the images are used if not given
+    """
+    image_list, timestamps = FT.frame_timestamps([x for x in os.listdir(path) if not x.startswith('.')],
+                                                 timestamps_path)
+    if not frame_rate:
+        frame_rate = round(FT.nominal_frame_rate(timestamps))
+    frames = FT.resample_frames(read_frames(path, image_list), timestamps, frame_rate)
+    frames_to_video(frames, video_output(path, video_ext), frame_rate, encoder, preset)
+
+
+def concat_list(path, image_list, durations):
+    """
+    :return: Content of an ffconcat file, which shows every image for its duration
+    """
+    lines = ['ffconcat version 1.0']
+    for image_name, duration in zip(image_list, durations):
+        lines.append("file '{}'".format(os.path.abspath(path + image_name).replace("'", "'\\''")))
+        lines.append("duration {:.6f}".format(duration))
+    # The duration of the last entry is only applied if it is followed by another one
+    lines.append(lines[-2])
+    return '\n'.join(lines) + '\n'
+
+
+def vfr_to_video(path, video_ext="mp4", encoder=None, preset=None, timestamps_path=None):
+    """
+    Generates a variable frame rate video of the images in path. Every image is shown from its own timestamp until
+    the timestamp of the next one, so the video has exactly the timing of the recording. The images are passed to
+    ffmpeg with their durations as ffconcat list and decoded by ffmpeg.
+
+    :param path: path to the images
+    :param video_ext: output format of the video, it has to support variable frame rates (e.g. mp4, mkv, mov)
+    :param encoder: ffmpeg video encoder (e.g. libx264), ffmpeg's default for the format if not given
+    :param preset: Encoder preset (e.g. ultrafast), encoder's default if not given
+    :param timestamps_path: timestamps file of the camera, the names of the images are used if not given
+    """
+    image_list, timestamps = FT.frame_timestamps([x for x in os.listdir(path) if not x.startswith('.')],
+                                                 timestamps_path)
+    output = video_output(path, video_ext)
+
+    fd, list_path = tempfile.mkstemp(suffix='.ffconcat', dir='out')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(concat_list(path, image_list, FT.frame_durations(timestamps)))
+        command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                   '-vsync', 'vfr']
+        if encoder:
+            command += ['-c:v', encoder]
+        if preset:
+            command += ['-preset', preset]
+        command.append(output)
+        with P.measure('video encode', items=len(image_list)):
+            result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE)
+    finally:
+        os.remove(list_path)
+    if result.returncode != 0:
+        raise Exception("ffmpeg failed to encode {} (exit code {}): {}".format(
+            output, result.returncode, result.stderr.decode('utf-8', errors='replace').strip()))
+
+
+def video_output(path, video_ext):
+    """
+    :return: Path of the video of the images in path (out/<directory name>.<video_ext>), out/ is created if needed
+    """
+    name = os.path.basename(os.path.normpath(path))
+
+    # create output directory if it doesn't exist yet
+    if not os.path.exists('out'):
+        os.makedirs('out')
+    return "out/{}.{}".format(name, video_ext)
+
+
+def convert_to_video(path, video_ext="mp4", frame_rate=None, encoder=None, preset=None, timing=None,
+                     timestamps_path=None):
+    """
+    This method generates a video file out of the images in path. Depending on 'timing' the video has the timing
+    of the recording ('vfr', see vfr_to_video), is resampled to a constant frame rate ('resample', see
+    resample_to_video) or shows every image for 1 / frame_rate seconds ('fixed', see stream_to_video).
+
+    :param path: path to the images
+    :param video_ext: output format of the video (e.g. mp4, mov, wmv, flv, avi, webm, mkv, ...)
+    :param frame_rate: frame rate of the video for 'resample' and 'fixed' (25 if not given)
+    :param encoder: ffmpeg video encoder (e.g. libx264), ffmpeg's default for the format if not given
+    :param preset: Encoder preset (e.g. ultrafast), encoder's default if not given
+    :param timing: 'vfr', 'resample' or 'fixed'. If not given, 'fixed' is used if a frame rate is given and 'vfr'
+                   otherwise.
+    :param timestamps_path: timestamps file of the camera, the names of the images are used if not given
+    """
+    if timing is None:
+        timing = 'fixed' if frame_rate else 'vfr'
+
+    if timing == 'vfr':
+        vfr_to_video(path, video_ext, encoder, preset, timestamps_path)
+    elif timing == 'resample':
+        resample_to_video(path, video_ext, frame_rate, encoder, preset, timestamps_path)
+    elif timing == 'fixed':
+        stream_to_video(path, video_ext, frame_rate or 25, encoder, preset)
+    else:
+        raise Exception("Unknown timing '{}', valid are 'vfr', 'resample' and 'fixed'.".format(timing))